@@ -0,0 +1,307 @@
+"""
+Допуск запросов к LLM (admission control): бюджеты токенов и приоритет воронки.
+
+Любой пользователь может засыпать свободный чат сообщениями, и каждое — это
+генерация до 800 токенов. Несколько таких пользователей съедают квоту и слоты
+LLM-клиента у всех остальных. Поэтому перед запросом к модели:
+
+— Ведро токенов (token bucket) на пользователя и общее на бота: пополняются
+  с постоянной скоростью до потолка. Перед запросом из обоих ведер резервируется
+  reserve_tokens, после ответа резерв заменяется фактическим расходом из поля
+  usage Responses API (вход + выход, включая свёртку памяти).
+— Приоритет: пользователи в воронке (и комментарий к расчёту) могут тратить общее
+  ведро до дна, свободный чат — только до chat_global_floor от потолка. Одновременных
+  запросов свободного чата не больше chat_max_inflight — остальные слоты LLM-клиента
+  всегда есть у воронки; сверх лимита запрос ждёт слот не дольше chat_queue_timeout.
+— Бюджет исчерпан — OverBudget, а бот отвечает дешёвым локальным текстом вместо
+  того, чтобы ставить запрос в очередь.
+
+Лимиты по умолчанию — из переменных окружения; на ходу их можно поменять JSON-файлом
+ADMISSION_CONFIG (перечитывается при изменении) или вызовом configure().
+"""
+
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+
+from metrics import ADMISSION_DECISIONS, LLM_BUDGET_TOKENS
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    CHAT = 0
+    FUNNEL = 1
+
+
+@dataclass(frozen=True, slots=True)
+class AdmissionLimits:
+    enabled: bool = True
+    # Токены в минуту и потолок ведра на одного пользователя
+    user_tokens_per_min: float = 4000.0
+    user_burst: float = 12000.0
+    # То же для всего бота (один процесс; в webhook-режиме — на воркер)
+    global_tokens_per_min: float = 200000.0
+    global_burst: float = 200000.0
+    # Сколько резервировать на запрос до ответа: инструкции + память + ответ
+    reserve_tokens: float = 1500.0
+    # Доля общего потолка, которую свободный чат не трогает — запас для воронки
+    chat_global_floor: float = 0.2
+    chat_max_inflight: int = 6
+    chat_queue_timeout: float = 10.0
+
+    @classmethod
+    def from_env(cls) -> "AdmissionLimits":
+        return cls(
+            enabled=os.getenv("LLM_ADMISSION", "1") == "1",
+            user_tokens_per_min=float(os.getenv("LLM_USER_TOKENS_PER_MIN", "4000")),
+            user_burst=float(os.getenv("LLM_USER_TOKEN_BURST", "12000")),
+            global_tokens_per_min=float(os.getenv("LLM_GLOBAL_TOKENS_PER_MIN", "200000")),
+            global_burst=float(os.getenv("LLM_GLOBAL_TOKEN_BURST", "200000")),
+            reserve_tokens=float(os.getenv("LLM_REQUEST_RESERVE_TOKENS", "1500")),
+            chat_global_floor=float(os.getenv("LLM_CHAT_GLOBAL_FLOOR", "0.2")),
+            chat_max_inflight=int(os.getenv("LLM_CHAT_MAX_INFLIGHT", "6")),
+            chat_queue_timeout=float(os.getenv("LLM_CHAT_QUEUE_TIMEOUT", "10")),
+        )
+
+    def replace(self, overrides: dict) -> "AdmissionLimits":
+        """Новые лимиты поверх текущих; незнакомые ключи пропускаем с предупреждением."""
+        names = {f.name for f in dataclasses.fields(self)}
+        unknown = set(overrides) - names
+        if unknown:
+            logger.warning("Незнакомые параметры лимитов LLM: %s", ", ".join(sorted(unknown)))
+        return dataclasses.replace(self, **{k: v for k, v in overrides.items() if k in names})
+
+
+class OverBudget(Exception):
+    """Запрос не допущен: reason — user / global / busy, retry_after — через сколько секунд пробовать."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"{reason}: повторить через {retry_after:.0f} с")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("level", "updated_at")
+
+    def __init__(self, level: float, now: float):
+        self.level = level
+        self.updated_at = now
+
+    def refill(self, per_min: float, burst: float, now: float) -> float:
+        self.level = min(burst, self.level + (now - self.updated_at) * per_min / 60)
+        self.updated_at = now
+        return self.level
+
+
+class Ticket:
+    """Допущенный запрос: резерв в ведрах и учёт фактического расхода."""
+
+    __slots__ = ("_control", "user_bucket", "priority", "reserved", "used")
+
+    def __init__(self, control: "AdmissionControl", user_bucket: TokenBucket | None, priority: Priority, reserved: float):
+        self._control = control
+        self.user_bucket = user_bucket
+        self.priority = priority
+        self.reserved = reserved
+        self.used = 0
+
+    def record(self, usage: dict | None) -> None:
+        """Учесть usage одного ответа модели (их может быть несколько: ответ + свёртка памяти)."""
+        if usage:
+            self.used += (usage.get("input_tokens") or 0) + (usage.get("output_tokens") or 0)
+
+    def close(self) -> None:
+        """
+        Заменить резерв фактическим расходом. Если usage так и не пришёл (ошибка,
+        отмена посреди стрима), резерв остаётся списанным: токены, скорее всего, потрачены.
+        """
+        if self._control is None:
+            return
+        control, self._control = self._control, None
+        if self.used:
+            control._charge(self.user_bucket, self.used - self.reserved)
+        control._release(self.priority)
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class AdmissionControl:
+    def __init__(
+        self,
+        limits: AdmissionLimits | None = None,
+        config_path: str | None = None,
+        reload_interval: float = 5.0,
+    ):
+        self.base_limits = limits or AdmissionLimits()
+        self.limits = self.base_limits
+        self.config_path = config_path
+        self.reload_interval = reload_interval
+
+        now = time.monotonic()
+        self._global = TokenBucket(self.limits.global_burst, now)
+        self._users: dict[int, TokenBucket] = {}
+        self._chat_inflight = 0
+        self._chat_slots = asyncio.Condition()
+        self._notifiers: set[asyncio.Task] = set()
+        self._config_mtime: float | None = None
+        self._checked_at = 0.0
+        self._pruned_at = now
+
+    @classmethod
+    def from_env(cls) -> "AdmissionControl":
+        return cls(
+            limits=AdmissionLimits.from_env(),
+            config_path=os.getenv("ADMISSION_CONFIG") or None,
+        )
+
+    # ---------------------------
+    # Настройка на ходу
+    # ---------------------------
+
+    def configure(self, **overrides) -> AdmissionLimits:
+        self.limits = self.limits.replace(overrides)
+        logger.info("Лимиты LLM: %s", dataclasses.asdict(self.limits))
+        return self.limits
+
+    def _maybe_reload(self, now: float) -> None:
+        """Перечитать ADMISSION_CONFIG, если файл поменялся (проверяем не чаще reload_interval)."""
+        if self.config_path is None or now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.config_path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._config_mtime:
+            return
+        self._config_mtime = mtime
+
+        overrides = {}
+        if mtime is not None:
+            try:
+                with open(self.config_path, encoding="utf-8") as f:
+                    overrides = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Не удалось прочитать %s, лимиты не изменены: %s", self.config_path, e)
+                return
+        # Файл удалили — возвращаемся к значениям из окружения
+        self.limits = self.base_limits.replace(overrides)
+        logger.info("Лимиты LLM: %s", dataclasses.asdict(self.limits))
+
+    # ---------------------------
+    # Допуск
+    # ---------------------------
+
+    def _user_bucket(self, user_id: int, now: float) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.limits.user_burst, now)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        """Полное ведро ничем не отличается от нового — не держим такие в памяти."""
+        if now - self._pruned_at < 60:
+            return
+        self._pruned_at = now
+        limits = self.limits
+        full = [
+            uid for uid, bucket in self._users.items()
+            if bucket.refill(limits.user_tokens_per_min, limits.user_burst, now) >= limits.user_burst
+        ]
+        for uid in full:
+            del self._users[uid]
+
+    @staticmethod
+    def _refill_time(deficit: float, per_min: float) -> float:
+        return deficit * 60 / per_min if per_min > 0 else 60.0
+
+    def _reject(self, reason: str, priority: Priority, retry_after: float) -> OverBudget:
+        ADMISSION_DECISIONS.inc(priority=priority.name.lower(), result=reason)
+        return OverBudget(reason, retry_after)
+
+    async def admit(self, user_id: int | None, priority: Priority = Priority.CHAT) -> Ticket:
+        """
+        Зарезервировать бюджет под запрос. user_id=None — запрос не от пользователя
+        (комментарий к расчёту): только общее ведро. Бросает OverBudget.
+        """
+        now = time.monotonic()
+        self._maybe_reload(now)
+        self._prune(now)
+        limits = self.limits
+        reserve = limits.reserve_tokens if limits.enabled else 0.0
+
+        user_bucket = None
+        if user_id is not None:
+            user_bucket = self._user_bucket(user_id, now)
+            level = user_bucket.refill(limits.user_tokens_per_min, limits.user_burst, now)
+            if limits.enabled and level < reserve:
+                raise self._reject(
+                    "user", priority, self._refill_time(reserve - level, limits.user_tokens_per_min)
+                )
+
+        level = self._global.refill(limits.global_tokens_per_min, limits.global_burst, now)
+        floor = limits.global_burst * limits.chat_global_floor if priority == Priority.CHAT else 0.0
+        if limits.enabled and level - reserve < floor:
+            raise self._reject(
+                "global", priority, self._refill_time(floor + reserve - level, limits.global_tokens_per_min)
+            )
+
+        if priority == Priority.CHAT:
+            await self._acquire_chat_slot(limits)
+
+        # Резервируем после ожидания слота: за это время ведра могли пополниться
+        self._charge(user_bucket, reserve)
+        ADMISSION_DECISIONS.inc(priority=priority.name.lower(), result="ok")
+        return Ticket(self, user_bucket, priority, reserve)
+
+    async def _acquire_chat_slot(self, limits: AdmissionLimits) -> None:
+        if not limits.enabled:
+            self._chat_inflight += 1
+            return
+        async with self._chat_slots:
+            try:
+                await asyncio.wait_for(
+                    self._chat_slots.wait_for(lambda: self._chat_inflight < self.limits.chat_max_inflight),
+                    limits.chat_queue_timeout,
+                )
+            except asyncio.TimeoutError:
+                raise self._reject("busy", Priority.CHAT, limits.chat_queue_timeout) from None
+            self._chat_inflight += 1
+
+    def _charge(self, user_bucket: TokenBucket | None, tokens: float) -> None:
+        # Уровень может уйти в минус: перерасход отрабатывается ожиданием пополнения
+        if user_bucket is not None:
+            user_bucket.level -= tokens
+        self._global.level -= tokens
+        LLM_BUDGET_TOKENS.set(self._global.level, scope="global")
+
+    def _release(self, priority: Priority) -> None:
+        if priority != Priority.CHAT:
+            return
+        self._chat_inflight -= 1
+        task = asyncio.get_running_loop().create_task(self._notify_chat_slots())
+        self._notifiers.add(task)
+        task.add_done_callback(self._notifiers.discard)
+
+    async def _notify_chat_slots(self) -> None:
+        # notify_all: условие проверяется заново, а лимит могли поднять на ходу
+        async with self._chat_slots:
+            self._chat_slots.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "global_tokens": round(self._global.level),
+            "tracked_users": len(self._users),
+            "chat_inflight": self._chat_inflight,
+        }
@@ -0,0 +1,77 @@
+"""
+Микробенчмарк локального разбора сообщений.
+
+Сравнивает старую маршрутизацию (линейный перебор triggers + re.search телефона
+на каждом сообщении) с движком intents.py и меряет разбор телефона, счёта
+и поиск региона по справочнику.
+
+Запуск: python benchmarks/bench_intents.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from intents import detect_intents, parse_bill, parse_phone, template_reply  # noqa: E402
+from regions import lookup_region, region_index  # noqa: E402
+
+MESSAGES = [
+    "Привет!",
+    "Это же дорого",
+    "А если отключат свет?",
+    "Хочу солнечную станцию на дачу",
+    "Расскажи, что нового у Tesla и SpaceX, и правда ли, что Марс скоро колонизируют?",
+    "У нас мало солнца",
+    "Сколько стоит станция на 10 кВт для дома в Краснодарском крае?",
+    "ок",
+]
+# Не должны получать шаблонный ответ: обращение, а не возражение; похожие слова
+NOT_TEMPLATED = ["Дорогой домовой!", "Дорогой мой домовой", "хайп", "салютую", "дорога к дому"]
+PHONES = ["+7 (912) 345-67-89", "89123456789", "мой номер 912 345 67 89", "не дам"]
+BILLS = ["5000", "около пяти тысяч", "4-5 тыс", "примерно 3 500 ₽ зимой", "не помню"]
+REGIONS = ["Подмосковье", "Краснодарский", "под Тулой", "Сочи", "крансодар", "Марс"]
+
+LEGACY_TRIGGERS = [
+    "дом", "квартира", "дача", "коттедж",
+    "электричество", "свет", "квт", "кВт",
+    "счёт", "оплата", "энергия", "сэс", "солнечн",
+]
+
+
+def legacy_route(text: str) -> bool:
+    re.search(r'(\+7|8)\s?\(?\d{3}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}', text)
+    return any(word in text.lower() for word in LEGACY_TRIGGERS)
+
+
+def engine_route(text: str) -> bool:
+    match = detect_intents(text)
+    return template_reply(match) is not None or match.trigger
+
+
+def bench(name: str, func, inputs: list[str], number: int = 20000) -> None:
+    total = timeit.timeit(lambda: [func(x) for x in inputs], number=number)
+    per_call = total / (number * len(inputs)) * 1e6
+    print(f"{name:<28} {per_call:8.2f} мкс/сообщение")
+
+
+def check_negatives() -> None:
+    wrong = [text for text in NOT_TEMPLATED if template_reply(detect_intents(text)) is not None]
+    if wrong:
+        raise SystemExit(f"Ложные срабатывания шаблонов: {wrong}")
+
+
+def main() -> None:
+    check_negatives()
+    bench("старая маршрутизация", legacy_route, MESSAGES)
+    bench("detect_intents + шаблон", engine_route, MESSAGES)
+    bench("parse_phone", parse_phone, PHONES)
+    bench("parse_bill", parse_bill, BILLS)
+    bench("поиск региона (без кэша)", region_index().lookup, REGIONS)
+    bench("lookup_region (с кэшем)", lookup_region, REGIONS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+"""
+Нагрузочный тест бота с локальными заглушками Telegram и OpenAI.
+
+— Поднимает фейковый Responses API (aiohttp) с настраиваемой задержкой,
+  потоковой выдачей и инъекцией ошибок 429/5xx.
+— Подменяет транспорт Bot API (FakeTelegramRequest): getMe/sendMessage/
+  editMessageText/... отвечают локально и записываются.
+— Собирает настоящее Application из bot.build_application() и прогоняет через
+  него тысячи синтетических пользователей по всей воронке:
+  /start → чат → объект → регион → счёт → имя → телефон → done.
+— Отчёт: пропускная способность, p50/p95/p99 по этапам, лаг event loop,
+  память на пользователя. Результаты можно сохранить как baseline и сравнивать.
+  По этапам меряется время обработчика (как UPDATE_LATENCY phase="handle"), без
+  ожидания слота MAX_CONCURRENT_CHATS: иначе очередь в сотни мс прячет регрессии
+  в десятки мс. Полное время с ожиданием — в stages_total, для справки.
+
+Запуск:
+    python benchmarks/loadtest.py --users 2000 --concurrency 300
+    python benchmarks/loadtest.py --save-baseline benchmarks/baseline.json
+    python benchmarks/loadtest.py --compare benchmarks/baseline.json
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from telegram.request import BaseRequest, RequestData  # noqa: E402
+
+BOT_TOKEN = "123456:loadtest"
+BOT_ID = 123456
+
+REGIONS = ["Подмосковье", "Краснодарский край", "Казань", "Новосибирская область", "Крым"]
+BILLS = ["3000", "около пяти тысяч", "4-5 тыс", "8 000 ₽", "15к"]
+
+# (этап, текст сообщения)
+FUNNEL = [
+    ("start", "/start"),
+    ("chat_llm", "Расскажи, как там дела на Марсе?"),
+    ("chat_trigger", "Хочу солнечную станцию для дома"),
+    ("object", "Частный дом"),
+    ("region", None),
+    ("bill", None),
+    ("name", "Иван"),
+    ("phone", "+7 912 345 67 89"),
+    ("done_llm", "А сколько прослужат панели?"),
+]
+
+
+# ===========================
+# ФЕЙКОВЫЙ OPENAI
+# ===========================
+
+class FakeResponsesAPI:
+    """Responses API с задержкой первого токена, потоковой выдачей и ошибками."""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, throttle_rate: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.requests = 0
+        self.errors = 0
+        self._runner: web.AppRunner | None = None
+
+    def _delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        payload = await request.json()
+
+        roll = random.random()
+        if roll < self.throttle_rate:
+            self.errors += 1
+            return web.Response(status=429, text="rate limited", headers={"Retry-After": "0.05"})
+        if roll < self.throttle_rate + self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="overloaded")
+
+        words = ("Солнце не присылает счета — это физика, а не магия. " * 4).split(" ")
+        input_tokens = len(json.dumps(payload, ensure_ascii=False)) // 3
+        usage = {"input_tokens": input_tokens, "output_tokens": len(words)}
+
+        await asyncio.sleep(self._delay())
+        if not payload.get("stream"):
+            return web.json_response({"output_text": " ".join(words), "usage": usage})
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for word in words:
+            event = {"type": "response.output_text.delta", "delta": word + " "}
+            await resp.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(0.005)
+        done = {"type": "response.completed", "response": {"usage": usage}}
+        await resp.write(f"data: {json.dumps(done)}\n\n".encode())
+        return resp
+
+    async def start(self, port: int) -> str:
+        app = web.Application()
+        app.router.add_post("/v1/responses", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        return f"http://127.0.0.1:{port}/v1"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# ===========================
+# ФЕЙКОВЫЙ TELEGRAM
+# ===========================
+
+class FakeTelegramRequest(BaseRequest):
+    """Транспорт Bot API, который отвечает локально и записывает отправленное."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: dict[str, int] = defaultdict(int)
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": params.get("message_id", self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+            "text": params.get("text", ""),
+        }
+
+    async def do_request(self, url, method, request_data: RequestData | None = None, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == "getMe":
+            result = {
+                "id": BOT_ID, "is_bot": True, "first_name": "Домовой", "username": "loadtest_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False,
+                "supports_inline_queries": False,
+            }
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+# ===========================
+# ИЗМЕРЕНИЯ
+# ===========================
+
+class LoopLagMonitor:
+    """Насколько позже запланированного просыпается event loop (признак блокировок)."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values, default=0.0) * 1000, 2),
+    }
+
+
+def state_bytes_per_user(user_data: dict, samples: int = 1000) -> float:
+    """Сколько памяти занимает состояние одного пользователя (по копиям через tracemalloc)."""
+    if not user_data:
+        return 0.0
+    template = next(iter(user_data.values()))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    copies = [copy.deepcopy(template) for _ in range(samples)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copies
+    return (after - before) / samples
+
+
+# ===========================
+# ПРОГОН
+# ===========================
+
+async def run(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix="domovoy-loadtest-")
+    llm_api = FakeResponsesAPI(args.llm_latency, args.llm_jitter, args.llm_error_rate, args.llm_429_rate)
+    base_url = await llm_api.start(args.llm_port)
+
+    os.environ.update(
+        TELEGRAM_BOT_TOKEN=BOT_TOKEN,
+        OPENAI_API_KEY="loadtest",
+        OPENAI_BASE_URL=base_url,
+        OPENAI_STREAM="1" if args.stream else "0",
+        # Каждое сообщение — отдельный запрос: меряем сам ответ, а не окно склейки
+        COALESCE_WINDOW="0",
+        # Тысячи синтетических пользователей за минуту упёрлись бы в бюджет токенов:
+        # учёт идёт, но без отказов
+        LLM_ADMISSION="0",
+        LEAD_STORE_PATH=os.path.join(workdir, "leads.jsonl"),
+        STATE_DB_PATH=os.path.join(workdir, "state.db"),
+        COMMENTARY_CACHE_PATH=os.path.join(workdir, "commentary_cache.db"),
+        OUTBOX_PATH=os.path.join(workdir, "outbox.db"),
+    )
+    os.chdir(workdir)  # leads.json и прочие относительные пути — во временной папке
+
+    import bot
+    from telegram import Update
+
+    tg = FakeTelegramRequest(latency=args.tg_latency)
+    app = bot.build_application(polling=False, request=tg)
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    totals: dict[str, list[float]] = defaultdict(list)
+    failures = 0
+    update_ids = iter(range(1, 10**9))
+    users = asyncio.Semaphore(args.concurrency)
+
+    async def handled(coroutine, stage: str) -> None:
+        # Корутина стартует, когда процессор дал чату слот, — отсюда и меряем
+        started = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            latencies[stage].append(time.perf_counter() - started)
+
+    async def walk(user_id: int) -> None:
+        async with users:
+            for stage, text in FUNNEL:
+                if text is None:
+                    text = random.choice(REGIONS if stage == "region" else BILLS)
+                update = Update.de_json(make_update(next(update_ids), user_id, text), app.bot)
+
+                started = time.perf_counter()
+                await app.update_processor.process_update(update, handled(app.process_update(update), stage))
+                totals[stage].append(time.perf_counter() - started)
+
+                if args.think:
+                    await asyncio.sleep(random.uniform(0, args.think))
+
+    async def count_error(update: object, context) -> None:
+        nonlocal failures
+        failures += 1
+        if failures <= 3:
+            logging.error("Ошибка обработчика", exc_info=context.error)
+
+    app.add_error_handler(count_error)
+
+    monitor = LoopLagMonitor()
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        monitor.start()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(walk(100_000 + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        await monitor.stop()
+        per_user = state_bytes_per_user(app.user_data)
+        await app.stop()
+    await app.post_shutdown(app)
+
+    await llm_api.stop()
+
+    updates = sum(len(v) for v in latencies.values())
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "updates": updates,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(updates / elapsed, 1),
+        "failures": failures,
+        "stages": {stage: summarize(latencies[stage]) for stage, _ in FUNNEL},
+        "stages_total": {stage: summarize(totals[stage]) for stage, _ in FUNNEL},
+        "loop_lag": summarize(monitor.samples),
+        "llm": {"requests": llm_api.requests, "injected_errors": llm_api.errors},
+        "telegram_calls": dict(tg.calls),
+        "state_bytes_per_user": round(per_user, 1),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# ===========================
+# ОТЧЁТ И BASELINE
+# ===========================
+
+def print_report(result: dict) -> None:
+    print(
+        f"\nПользователей: {result['users']} (одновременно {result['concurrency']}), "
+        f"апдейтов: {result['updates']}, время: {result['elapsed_s']} с, "
+        f"пропускная способность: {result['throughput_ups']} апд/с, ошибок: {result['failures']}"
+    )
+    print("\nОбработчик (без ожидания очереди) | p95 с ожиданием")
+    print(f"{'этап':<14}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'p95 всего':>12}")
+    for stage, s in result["stages"].items():
+        total = result["stages_total"][stage]["p95_ms"]
+        print(f"{stage:<14}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}{total:>12}")
+    lag = result["loop_lag"]
+    print(f"\nЛаг event loop: p50 {lag['p50_ms']} мс, p99 {lag['p99_ms']} мс, max {lag['max_ms']} мс")
+    print(f"LLM: {result['llm']}")
+    print(f"Telegram: {result['telegram_calls']}")
+    print(
+        f"Состояние на пользователя: {result['state_bytes_per_user']} байт, "
+        f"max RSS: {result['max_rss_mb']} МБ"
+    )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Список регрессий относительно baseline (пустой — всё в порядке)."""
+    problems = []
+    if result["throughput_ups"] < baseline["throughput_ups"] * (1 - tolerance):
+        problems.append(
+            f"пропускная способность {result['throughput_ups']} < {baseline['throughput_ups']}"
+        )
+    for stage, s in result["stages"].items():
+        base = baseline["stages"].get(stage)
+        # Для совсем быстрых этапов относительный допуск бессмыслен — даём запас 5 мс
+        if base and s["p95_ms"] > base["p95_ms"] * (1 + tolerance) + 5:
+            problems.append(f"{stage}: p95 {s['p95_ms']} мс > {base['p95_ms']} мс")
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200, help="одновременно активных пользователей")
+    parser.add_argument("--think", type=float, default=0.05, help="пауза между сообщениями пользователя, до N с")
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы модели")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--llm-error-rate", type=float, default=0.02)
+    parser.add_argument("--llm-429-rate", type=float, default=0.02)
+    parser.add_argument("--llm-port", type=int, default=18080)
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="задержка фейкового Bot API, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, force=True)
+    if not args.verbose:
+        # Повторы после инъецированных ошибок — ожидаемы, не засоряем ими отчёт
+        logging.getLogger("llm_client").setLevel(logging.ERROR)
+    random.seed(args.seed)
+
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    result = asyncio.run(run(args))
+    print_report(result)
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nBaseline сохранён: {save_path}")
+
+    if compare_path:
+        with open(compare_path, encoding="utf-8") as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        if problems:
+            print("\nРЕГРЕССИИ:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("\nРегрессий относительно baseline нет.")
+
+
+if __name__ == "__main__":
+    main()
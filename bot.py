@@ -1,16 +1,52 @@
 import os
 import json
-import re
+import asyncio
 import logging
-import aiohttp
+import time
+from collections import Counter
+from functools import partial
 from datetime import datetime
+from typing import AsyncIterator, Callable
 from telegram import Update
+from telegram.constants import ChatAction
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler,
+    Application, ApplicationBuilder, CommandHandler, MessageHandler,
     ContextTypes, filters
 )
 
-logging.basicConfig(level=logging.INFO)
+from admission import AdmissionControl, OverBudget, Priority, Ticket
+from coalescer import ChatCoalescer
+from commentary_cache import CommentaryCache
+from estimator import estimate, lead_bill, lead_category, normalize_region
+from regions import lookup_region
+from intents import detect_intents, parse_phone, template_reply
+from lead_store import LeadStore, create_lead_store, migrate_legacy_json
+from llm_client import LLMError, extract_output_text
+from llm_router import LLMRouter
+from memory import ConversationMemory
+from metrics import (
+    COMMENTARY_DELIVERY,
+    FUNNEL_ABANDONED,
+    LEAD_SAVE,
+    LLM_FIRST_TOKEN,
+    LLM_LATENCY,
+    LLM_REQUESTS,
+    METRICS_PORT,
+    MetricsServer,
+    TimedRequest,
+    record_stage,
+    record_usage,
+    setup_logging,
+)
+from outbox import AdminOutbox
+from persistence import SqliteUserDataPersistence
+from update_processor import ChatOrderedUpdateProcessor
+from webhook import run_webhook
+from session import Session, SessionEvictor, Stage
+from streaming import stream_reply
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 
@@ -29,6 +65,12 @@ def _require_env(name: str) -> str | None:
 TELEGRAM_BOT_TOKEN = _require_env("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = _require_env("OPENAI_API_KEY")  # <-- теперь используем OpenAI
 ADMIN_CHANNEL_ID = os.getenv("ADMIN_CHANNEL_ID")  # не обязательная, поэтому без _require_env
+# Режим получения апдейтов: polling (локально) или webhook (прод, несколько воркеров)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Номер воркера в webhook-режиме; разовые задачи при старте выполняет только нулевой
+WORKER_SHARD = 0
+# Потоковые ответы в свободном чате: 1 — правим сообщение по мере генерации, 0 — ждём целиком
+OPENAI_STREAM = os.getenv("OPENAI_STREAM", "1") == "1"
 
 
 def _ensure_config() -> bool:
@@ -52,7 +94,7 @@ def _ensure_config() -> bool:
     return True
 
 
-LEADS_FILE = "leads.json"
+LEADS_FILE = "leads.json"  # старый формат, переносится в хранилище при запуске
 ADMIN_CHANNEL_ID = -1003065941838  # канал "Дом Солнца – Заявки от Домового"
 
 
@@ -156,85 +198,300 @@ SYSTEM_PROMPT = """
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ===========================
 
-def extract_phone(text: str) -> str | None:
-    pattern = r'(\+7|8)\s?\(?\d{3}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}'
-    match = re.search(pattern, text)
-    return match.group(0) if match else None
+# Общие ресурсы: создаются в post_init и закрываются в post_shutdown
+llm: LLMRouter | None = None
+lead_store: LeadStore | None = None
+commentary_cache: CommentaryCache | None = None
+admin_outbox: AdminOutbox | None = None
+metrics_server: MetricsServer | None = None
+coalescer: ChatCoalescer | None = None
+session_evictor: SessionEvictor | None = None
+admission: AdmissionControl | None = None
+_background_tasks: set[asyncio.Task] = set()
+
+# Сколько самых частых классов лидов прогревать в кэше комментариев при старте
+COMMENTARY_PREWARM = int(os.getenv("COMMENTARY_CACHE_PREWARM", "20"))
+# Комментарий к расчёту приходит отдельным сообщением: сколько ждать одну попытку
+# генерации и сколько попыток сделать, прежде чем молча обойтись без него
+COMMENTARY_TIMEOUT = float(os.getenv("COMMENTARY_TIMEOUT", "20"))
+COMMENTARY_ATTEMPTS = int(os.getenv("COMMENTARY_ATTEMPTS", "2"))
+
+
+def run_in_background(coro, name: str | None = None) -> asyncio.Task:
+    """Фоновая задача, которую post_shutdown отменит вместе с остальными."""
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# Системный промпт уходит отдельным полем instructions и не меняется между
+# запросами — провайдер кэширует этот префикс, и мы не платим за него каждый раз.
+INSTRUCTIONS = SYSTEM_PROMPT + "\n\nДай ответ пользователю в этом же стиле."
+
+SUMMARY_INSTRUCTIONS = (
+    "Ты ведёшь краткий конспект диалога клиента с консультантом по солнечным станциям. "
+    "Обнови конспект с учётом новых реплик: факты о клиенте, его вопросы и возражения, "
+    "что уже обсудили. Не больше 5 коротких пунктов, без приветствий и оценок."
+)
+
+LLM_ERROR_MARK = "Ошибка OpenAI API"
+
+# Ответы без LLM, когда бюджет токенов исчерпан (см. admission). Воронка работает
+# локально, поэтому зовём в расчёт: слово «дом» или «счёт» её и запустит.
+OVER_BUDGET_REPLIES = {
+    "user": (
+        "Я сегодня разговорился — дайте мне пару минут остыть, как панелям в полдень ☀️\n"
+        "А расчёт станции могу сделать прямо сейчас: напишите, для дома, дачи или бизнеса."
+    ),
+    "busy": (
+        "Сейчас ко мне очередь из желающих перейти на солнце 🌞 Повторите вопрос через минутку.\n"
+        "А пока могу прикинуть станцию для вашего дома — хотите?"
+    ),
+}
+OVER_BUDGET_REPLIES["global"] = OVER_BUDGET_REPLIES["busy"]
+
+# Поля лида, которые полезно напомнить модели, чтобы она не переспрашивала
+LEAD_FACT_FIELDS = {"object": "объект", "region": "регион", "bill": "счёт за свет", "name": "имя"}
+
+
+def _lead_facts(lead: dict) -> str:
+    return "; ".join(
+        f"{title}: {lead[key]}" for key, title in LEAD_FACT_FIELDS.items() if lead.get(key)
+    )
+
+
+def _build_payload(
+    prompt: str, memory: ConversationMemory | None = None, facts: str = ""
+) -> dict:
+    return {
+        "model": "gpt-4o-mini",
+        "instructions": INSTRUCTIONS,
+        "input": memory.build_input(prompt, facts) if memory is not None else prompt,
+        "max_output_tokens": 800,
+    }
+
+
+def _log_usage(usage: dict | None, ticket: Ticket | None = None) -> None:
+    """Сколько токенов реально ушло в запрос — проверяем, что бюджет памяти держится."""
+    if not usage:
+        return
+    if ticket is not None:
+        ticket.record(usage)
+    record_usage(usage)
+    cached = (usage.get("input_tokens_details") or {}).get("cached_tokens", 0)
+    logger.info(
+        "Токены OpenAI: вход %s (из кэша %s), выход %s",
+        usage.get("input_tokens"), cached, usage.get("output_tokens"),
+    )
 
 
-async def ask_openai(prompt: str) -> str:
+async def ask_openai(
+    prompt: str, memory: ConversationMemory | None = None, facts: str = "", ticket: Ticket | None = None
+) -> str:
     """
-    Отправка запроса к OpenAI (модель o1-mini через /v1/responses).
+    Отправка запроса к OpenAI (модель gpt-4o-mini через /v1/responses).
+    С LLM_PROVIDERS запрос может уйти и к резервному провайдеру — см. llm_router.
     """
-    if not OPENAI_API_KEY:
+    if not OPENAI_API_KEY or llm is None:
         return "OpenAI API не настроен: отсутствует OPENAI_API_KEY."
 
-    url = "https://api.openai.com/v1/responses"
-
-    # Для o1-mini используем Responses API: передаём единый текст,
-    # в котором уже есть системные инструкции и сообщение пользователя.
-    full_input = (
-        SYSTEM_PROMPT
-        + "\n\n"
-        + "Пользователь пишет:\n"
-        + prompt
-        + "\n\n"
-        + "Дай ответ пользователю в этом же стиле."
-    )
+    started = time.perf_counter()
+    try:
+        data = await llm.create_response(_build_payload(prompt, memory, facts))
+    except asyncio.CancelledError:
+        LLM_REQUESTS.inc(mode="full", status="cancelled")
+        raise
+    except LLMError as e:
+        LLM_REQUESTS.inc(mode="full", status=e.status or "network")
+        logger.error("Ошибка OpenAI API: %s", e)
+        return f"{LLM_ERROR_MARK}: {e}"
+    LLM_LATENCY.observe(time.perf_counter() - started, mode="full")
+    LLM_REQUESTS.inc(mode="full", status="ok")
+
+    _log_usage(data.get("usage"), ticket)
+    text = extract_output_text(data)
+    if not text:
+        text = "Не получилось получить ответ от модели, попробуй спросить ещё раз."
 
-    payload = {
-        "model": "gpt-4o-mini",
-        "input": full_input,
-        "max_output_tokens": 800,
-    }
+    return text
 
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-    }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                logger.error("Ошибка OpenAI API: %s", text)
-                return f"Ошибка OpenAI API: {text}"
+async def ask_openai_stream(
+    prompt: str, memory: ConversationMemory | None = None, facts: str = "", ticket: Ticket | None = None
+) -> AsyncIterator[str]:
+    """
+    То же, что ask_openai, но отдаёт текст кусками по мере генерации (SSE).
+    """
+    if not OPENAI_API_KEY or llm is None:
+        yield "OpenAI API не настроен: отсутствует OPENAI_API_KEY."
+        return
 
-            data = await resp.json()
+    started = time.perf_counter()
+    first = True
+    try:
+        async for event in llm.stream_response(_build_payload(prompt, memory, facts)):
+            kind = event.get("type")
+            if kind == "response.output_text.delta":
+                # Первый кусок текста, а не response.created: его пользователь и увидит
+                if first:
+                    LLM_FIRST_TOKEN.observe(time.perf_counter() - started)
+                    first = False
+                yield event.get("delta", "")
+            elif kind == "response.completed":
+                LLM_LATENCY.observe(time.perf_counter() - started, mode="stream")
+                LLM_REQUESTS.inc(mode="stream", status="ok")
+                _log_usage(event.get("response", {}).get("usage"), ticket)
+            elif kind in ("response.failed", "error"):
+                LLM_REQUESTS.inc(mode="stream", status="failed")
+                logger.error("Ошибка OpenAI API (стрим): %s", event)
+                return
+    except asyncio.CancelledError:
+        LLM_REQUESTS.inc(mode="stream", status="cancelled")
+        raise
+    except LLMError as e:
+        LLM_REQUESTS.inc(mode="stream", status=e.status or "network")
+        logger.error("Ошибка OpenAI API: %s", e)
+        yield f"\n\n{LLM_ERROR_MARK}: {e}"
+
+
+async def summarize_dialogue(summary: str, turns: list[dict], ticket: Ticket | None = None) -> str:
+    """Свернуть старые реплики в обновлённый конспект (короткий дешёвый запрос)."""
+    if llm is None:
+        raise LLMError("LLM-клиент не запущен")
+
+    dialogue = "\n".join(
+        f"{'Клиент' if t['role'] == 'user' else 'Консультант'}: {t['content']}" for t in turns
+    )
+    data = await llm.create_response({
+        "model": "gpt-4o-mini",
+        "instructions": SUMMARY_INSTRUCTIONS,
+        "input": f"Текущий конспект:\n{summary or '—'}\n\nНовые реплики:\n{dialogue}",
+        "max_output_tokens": 250,
+    })
+    _log_usage(data.get("usage"), ticket)
+    return extract_output_text(data) or summary
 
-            # Пытаемся вытащить текст из разных полей (в зависимости от формата ответа)
-            text = data.get("output_text")
-            if not text:
-                parts = []
-                for item in data.get("output", []):
-                    for c in item.get("content", []):
-                        if c.get("type") in ("output_text", "text"):
-                            parts.append(c.get("text", ""))
-                text = "".join(parts)
 
-            if not text:
-                text = "Не получилось получить ответ от модели, попробуй спросить ещё раз."
+async def _notify_first(chunks: AsyncIterator[str], on_first: Callable[[], None]) -> AsyncIterator[str]:
+    async for delta in chunks:
+        if delta:
+            on_first()
+        yield delta
 
-            return text
 
+def llm_priority(context: ContextTypes.DEFAULT_TYPE) -> Priority:
+    """
+    Приоритет допуска к LLM: воронка (этапы waiting_*) впереди свободного чата.
+    Чат после заявки (done) — тоже свободный: дойти до done ничего не стоит,
+    иначе любой мог бы пройти воронку один раз и дальше слать запросы без очереди.
+    """
+    return Priority.FUNNEL if context.user_data.get("stage") in FUNNEL_STAGES else Priority.CHAT
 
-def save_lead(user_id: str, lead_data: dict) -> None:
-    """Сохраняем лид в leads.json"""
-    if not os.path.exists(LEADS_FILE):
-        with open(LEADS_FILE, "w", encoding="utf-8") as f:
-            json.dump({}, f, ensure_ascii=False, indent=2)
 
-    with open(LEADS_FILE, "r", encoding="utf-8") as f:
+async def reply_with_llm(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    prompt: str,
+    on_commit: Callable[[], None] | None = None,
+) -> str:
+    """
+    Ответить пользователю текстом модели — потоком или одним сообщением — с учётом памяти.
+    on_commit вызывается перед тем, как пользователь увидит ответ (см. coalescer);
+    до этого в чате ничего не появляется, даже заглушка.
+    Бюджет токенов исчерпан — отвечаем локальной заготовкой, без очереди к модели.
+    """
+    ticket = None
+    if admission is not None:
         try:
-            all_leads = json.load(f)
-        except json.JSONDecodeError:
-            all_leads = {}
+            ticket = await admission.admit(update.effective_user.id, llm_priority(context))
+        except OverBudget as e:
+            logger.info("Запрос к LLM не допущен (%s), отвечаем без модели", e)
+            if on_commit is not None:
+                on_commit()
+            reply = OVER_BUDGET_REPLIES[e.reason]
+            await update.message.reply_text(reply)
+            return reply
+
+    try:
+        memory = ConversationMemory.for_user(context.user_data)
+        facts = _lead_facts(context.user_data.get("lead", {}))
+
+        if OPENAI_STREAM:
+            chunks = ask_openai_stream(prompt, memory, facts, ticket)
+            if on_commit is not None:
+                chunks = _notify_first(chunks, on_commit)
+            reply = await stream_reply(update.message, chunks, placeholder=on_commit is None)
+        else:
+            reply = await ask_openai(prompt, memory, facts, ticket)
+            if on_commit is not None:
+                on_commit()
+            await update.message.reply_text(reply)
+
+        if LLM_ERROR_MARK not in reply:
+            memory.add_turn(prompt, reply)
+            await memory.compact(partial(summarize_dialogue, ticket=ticket))
+        return reply
+    finally:
+        if ticket is not None:
+            ticket.close()
+
+
+async def reply_in_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    """
+    Свободный диалог: сообщения, пришедшие подряд, склеиваются в один запрос к LLM.
+    Ответ генерируется в фоне, обработчик апдейта возвращается сразу.
+    """
+    if coalescer is None or not coalescer.enabled:
+        await reply_with_llm(update, context, text)
+        return
+
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+
+    async def generate(prompt: str, commit: Callable[[], None]) -> None:
+        await reply_with_llm(update, context, prompt, on_commit=commit)
+        # Память диалога поменялась уже после обработки апдейта — сохраняем явно
+        context.application.mark_data_for_update_persistence(user_ids=user_id)
+
+    coalescer.submit(
+        chat_id, text, generate,
+        lambda: context.bot.send_chat_action(chat_id, ChatAction.TYPING),
+    )
+
+
+def cancel_pending_reply(update: Update) -> None:
+    """Пользователь ушёл из свободного диалога — ответ на недосказанную пачку уже не нужен."""
+    if coalescer is not None and update.effective_chat is not None:
+        coalescer.cancel(update.effective_chat.id)
+
 
-    all_leads[user_id] = lead_data
+async def reply_with_template(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str, reply: str
+) -> None:
+    """Ответить готовым шаблоном и запомнить реплику, чтобы модель знала контекст."""
+    await update.message.reply_text(reply)
+    memory = ConversationMemory.for_user(context.user_data)
+    memory.add_turn(prompt, reply)
+    # Шаблонные реплики тоже копятся — сворачиваем, чтобы история держалась в бюджете
+    await memory.compact(partial(summarize_admitted, update.effective_user.id, llm_priority(context)))
 
-    with open(LEADS_FILE, "w", encoding="utf-8") as f:
-        json.dump(all_leads, f, ensure_ascii=False, indent=2)
 
+async def summarize_admitted(user_id: int, priority: Priority, summary: str, turns: list[dict]) -> str:
+    """
+    Свёртка памяти вне ответа модели — со своим допуском к LLM.
+    OverBudget — compact просто отбросит старое.
+    """
+    if admission is None:
+        return await summarize_dialogue(summary, turns)
+    with await admission.admit(user_id, priority) as ticket:
+        return await summarize_dialogue(summary, turns, ticket)
+
+
+async def save_lead(user_id: str, lead_data: dict) -> None:
+    """Сохраняем лид в хранилище (запись пачками в фоне, без блокировки event loop)"""
+    with LEAD_SAVE.time():
+        await lead_store.save(user_id, lead_data)
     logger.info("Лид сохранён: %s", lead_data)
 
 
@@ -266,65 +523,204 @@ def estimate_station(object_type: str, region: str, payment: int) -> str:
     )
 
 
+STATION_TYPES = {
+    "business": "гибридная или сетевая коммерческая станция",
+    "country": "автономная или гибридная станция (с аккумуляторами)",
+    "home": "домашняя сетевая или гибридная СЭС",
+}
+
+
 def calculate_solar_options(lead: dict) -> str:
     """
     Примерный расчёт станции по данным клиента.
     Это НЕ точная смета, а понятная прикидка для диалога.
     """
-    raw_bill = lead.get("bill", "")
-    digits = re.sub(r"[^\d]", "", raw_bill)
-    try:
-        bill = int(digits)
-    except ValueError:
-        bill = 5000  # если человек написал «около пяти», ставим дефолт
-
-    # Примем средний тариф ~6 ₽/кВт⋅ч
-    tariff = 6.0
-    monthly_kwh = bill / tariff
-    yearly_kwh = monthly_kwh * 12
-
-    # Очень грубо: 1 кВт СЭС даёт ~110–130 кВт⋅ч/мес
-    power_kw = round(monthly_kwh / 120, 1)
-    if power_kw < 1:
-        power_kw = 1.0
-
-    # Примерный бюджет (диапазон) — 70–110 тыс ₽ за 1 кВт
-    cost_min = int(power_kw * 70000)
-    cost_max = int(power_kw * 110000)
-
-    # Ориентировочная окупаемость
-    avg_cost = (cost_min + cost_max) / 2
-    payback_years = round(avg_cost / (bill * 12), 1)
-
-    obj = (lead.get("object", "") + " " + lead.get("region", "")).lower()
-
-    if any(w in obj for w in ["производ", "завод", "магазин", "склад", "бизнес"]):
-        station_type = "гибридная или сетевая коммерческая станция"
-    elif any(w in obj for w in ["дача", "дерев", "село", "ферма"]):
-        station_type = "автономная или гибридная станция (с аккумуляторами)"
-    else:
-        station_type = "домашняя сетевая или гибридная СЭС"
+    bill = lead_bill(lead)
+    category = lead_category(lead)
+    # Тариф и выработка — по справочнику регионов, остальные константы — в EstimateParams
+    region = lookup_region(lead.get("region", ""))
+    est = estimate(bill, category, normalize_region(lead.get("region", "")))
+
+    station_type = STATION_TYPES[category]
 
     text = (
         "🔎 Черновая прикидка по вашим данным:\n"
         f"• Тип объекта: {lead.get('object', '—')}\n"
         f"• Регион: {lead.get('region', '—')}\n"
         f"• Счёт за электричество: ~{bill} ₽/мес\n\n"
-        f"⚡ Ориентировочная мощность станции: ~{power_kw} кВт\n"
+        f"⚡ Ориентировочная мощность станции: ~{est.power_kw} кВт\n"
         f"🏗 Предполагаемый тип станции: {station_type}\n"
-        f"💰 Примерный бюджет под ключ: от {cost_min} до {cost_max} ₽\n"
-        f"⏱ Окупаемость: примерно {payback_years} лет (очень грубая оценка).\n"
+        f"💰 Примерный бюджет под ключ: от {est.cost_min} до {est.cost_max} ₽\n"
+        f"⏱ Окупаемость: примерно {est.payback_years} лет (очень грубая оценка).\n"
     )
+    if region is not None:
+        text += (
+            f"☀️ {region.name}: 1 кВт даёт от {min(region.monthly_yield)} кВт⋅ч/мес зимой "
+            f"до {max(region.monthly_yield)} летом, тариф ~{region.tariff} ₽/кВт⋅ч.\n"
+        )
     return text
 
 
+# ===========================
+# КОММЕНТАРИЙ ИНЖЕНЕРА (С КЭШЕМ)
+# ===========================
+
+# Границы корзин счёта, ₽/мес: комментарий зависит от порядка суммы, а не от точной цифры
+BILL_BUCKETS = (1500, 2500, 4000, 6000, 8000, 12000, 20000, 35000, 60000, 100000)
+
+OBJECT_TITLES = {
+    "business": "коммерческий объект (магазин, склад, производство)",
+    "country": "дача или загородный дом",
+    "home": "частный дом или квартира",
+}
+
+
+def bill_bucket(bill: int) -> int:
+    """Типичная сумма для корзины, в которую попал счёт."""
+    lower = 0
+    for upper in BILL_BUCKETS:
+        if bill < upper:
+            return (lower + upper) // 2
+        lower = upper
+    return BILL_BUCKETS[-1]
+
+
+def commentary_inputs(lead: dict) -> tuple[str, dict]:
+    """Нормализованные входы комментария: ключ кэша и «типовой» лид для промпта."""
+    category = lead_category(lead)
+    region = normalize_region(lead.get("region", ""))
+    bucket = bill_bucket(lead_bill(lead))
+    typical = {"object": OBJECT_TITLES[category], "region": region or "—", "bill": str(bucket)}
+    return f"{category}|{region}|{bucket}", typical
+
+
+async def _generate_commentary(typical: dict) -> str:
+    # Комментарий общий для класса лидов — тратит только общий бюджет, с приоритетом воронки
+    ticket = None
+    if admission is not None:
+        try:
+            ticket = await admission.admit(None, Priority.FUNNEL)
+        except OverBudget as e:
+            # С пометкой ошибки: не попадёт в кэш, а расчёт уйдёт без комментария
+            return f"{LLM_ERROR_MARK}: бюджет токенов исчерпан ({e})"
+    try:
+        return await ask_openai(
+            "Вот данные клиента и предварительный инженерный расчёт. "
+            "Аккуратно подтверди или скорректируй оценку, добавь 2–3 практичных совета. "
+            "Не проси повторно имя/телефон и не собирай данные ещё раз.\n\n"
+            f"Данные клиента: {json.dumps(typical, ensure_ascii=False)}\n\n"
+            f"Черновая оценка: {calculate_solar_options(typical)}",
+            ticket=ticket,
+        )
+    finally:
+        if ticket is not None:
+            ticket.close()
+
+
+async def engineer_commentary(lead: dict) -> str:
+    """Комментарий нейросети к расчёту — из кэша, если такой класс лидов уже встречался."""
+    key, typical = commentary_inputs(lead)
+    if commentary_cache is None:
+        return await _generate_commentary(typical)
+
+    return await commentary_cache.get_or_create(
+        key,
+        lambda: _generate_commentary(typical),
+        cacheable=lambda text: LLM_ERROR_MARK not in text,
+    )
+
+
+async def deliver_commentary(update: Update, context: ContextTypes.DEFAULT_TYPE, lead: dict) -> None:
+    """
+    Догнать расчёт комментарием нейросети. Воронку не держит: имя уже спрошено.
+    Не уложились в COMMENTARY_TIMEOUT — ждём ту же генерацию ещё раз (её ждут и другие
+    пользователи с тем же ключом кэша), ошибка — генерируем заново. После
+    COMMENTARY_ATTEMPTS попыток обходимся без комментария.
+    """
+    started = time.perf_counter()
+    result = "skipped"
+    task: asyncio.Task | None = None
+    try:
+        for attempt in range(1, COMMENTARY_ATTEMPTS + 1):
+            if task is None:
+                task = asyncio.ensure_future(engineer_commentary(lead))
+            try:
+                comment = await asyncio.wait_for(asyncio.shield(task), COMMENTARY_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Комментарий к расчёту не готов за %s с (попытка %s)", COMMENTARY_TIMEOUT, attempt)
+                continue
+            except Exception:
+                logger.exception("Ошибка при подготовке комментария (попытка %s)", attempt)
+                task = None
+                continue
+            task = None
+            if LLM_ERROR_MARK in comment:
+                logger.warning("Комментарий к расчёту не получен (попытка %s)", attempt)
+                continue
+
+            # Пока генерировали, пользователь начал заново (/start) — расчёт уже не о том
+            if context.user_data.get("lead") is not lead:
+                result = "stale"
+                return
+            await update.message.reply_text(comment)
+            result = "ok"
+            return
+    finally:
+        if task is not None:
+            # Отписываемся от генерации; общую (из кэша) остальные дождутся, и она закэшируется
+            task.cancel()
+        COMMENTARY_DELIVERY.observe(time.perf_counter() - started, result=result)
+
+
+async def prewarm_commentary(limit: int) -> None:
+    """Заранее сгенерировать комментарии для самых частых классов лидов из базы."""
+    def _top_inputs() -> list[tuple[str, dict]]:
+        counts: Counter[str] = Counter()
+        typical_by_key: dict[str, dict] = {}
+        for _, lead in lead_store.iter_leads():
+            key, typical = commentary_inputs(lead)
+            counts[key] += 1
+            typical_by_key[key] = typical
+        return [(key, typical_by_key[key]) for key, _ in counts.most_common(limit)]
+
+    warmed = 0
+    for key, typical in await asyncio.to_thread(_top_inputs):
+        if key in commentary_cache:
+            continue
+        # Последовательно, чтобы не занимать слоты LLM-клиента у живых пользователей
+        await commentary_cache.get_or_create(
+            key,
+            lambda typical=typical: _generate_commentary(typical),
+            cacheable=lambda text: LLM_ERROR_MARK not in text,
+        )
+        warmed += 1
+    logger.info("Кэш комментариев прогрет: %s новых записей", warmed)
+
+
 # ===========================
 # ОБРАБОТЧИКИ
 # ===========================
 
+# Этапы сбора данных: /start на любом из них — пользователь бросил воронку
+FUNNEL_STAGES = (
+    Stage.WAITING_FOR_OBJECT, Stage.WAITING_FOR_REGION, Stage.WAITING_FOR_BILL,
+    Stage.WAITING_FOR_NAME, Stage.WAITING_FOR_PHONE,
+)
+
+
+def set_stage(context: ContextTypes.DEFAULT_TYPE, stage: Stage) -> None:
+    """Перевести пользователя на этап воронки (с учётом в метриках переходов)."""
+    record_stage(context.user_data.get("stage", Stage.CHAT), stage)
+    context.user_data["stage"] = stage
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["stage"] = "chat"
+    if context.user_data.get("stage") in FUNNEL_STAGES:
+        FUNNEL_ABANDONED.inc(stage=context.user_data["stage"])
+    cancel_pending_reply(update)
+    set_stage(context, Stage.CHAT)
     context.user_data["lead"] = {}
+    context.user_data.pop("memory", None)
 
     await update.message.reply_text(
         "Привет! Я Домовой Дом Солнца ☀️\n"
@@ -339,41 +735,40 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
-    stage = context.user_data.get("stage", "chat")
+    stage = context.user_data.get("stage", Stage.CHAT)
     lead = context.user_data.get("lead", {})
 
     # ----------------------------------------
     # ЭТАП 5 — ЧЕЛОВЕК ДАЛ ТЕЛЕФОН
     # ----------------------------------------
-    phone = extract_phone(text)
-    if stage == "waiting_for_phone":
+    if stage == Stage.WAITING_FOR_PHONE:
+        phone = parse_phone(text)
         if not phone:
             await update.message.reply_text("Напиши номер в формате +7… 🌞")
             return
 
         lead["phone"] = phone
         lead["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M")
-        save_lead(str(update.message.from_user.id), lead)
+        await save_lead(str(update.message.from_user.id), lead)
 
-        # Отправляем заявку хозяину/менеджеру в Telegram, если указан ADMIN_CHANNEL_ID
+        # Ставим заявку в очередь уведомлений хозяину/менеджеру, если указан ADMIN_CHANNEL_ID.
+        # Доставляет её фоновая задача — ответ пользователю не ждёт Telegram.
         if ADMIN_CHANNEL_ID:
             try:
-                await context.application.bot.send_message(
-                    chat_id=int(ADMIN_CHANNEL_ID),
-                    text=(
-                        "🆕 Новая заявка от Домового:\n"
-                        f"• Имя: {lead.get('name', '—')}\n"
-                        f"• Телефон: {phone}\n"
-                        f"• Объект: {lead.get('object', '—')}\n"
-                        f"• Регион: {lead.get('region', '—')}\n"
-                        f"• Счёт за свет: {lead.get('bill', '—')}\n"
-                        f"• Время: {lead.get('timestamp')}"
-                    )
+                await admin_outbox.enqueue(
+                    int(ADMIN_CHANNEL_ID),
+                    "🆕 Новая заявка от Домового:\n"
+                    f"• Имя: {lead.get('name', '—')}\n"
+                    f"• Телефон: {phone}\n"
+                    f"• Объект: {lead.get('object', '—')}\n"
+                    f"• Регион: {lead.get('region', '—')}\n"
+                    f"• Счёт за свет: {lead.get('bill', '—')}\n"
+                    f"• Время: {lead.get('timestamp')}",
                 )
             except Exception as e:
-                logger.error("Не удалось отправить лид администратору: %s", e)
+                logger.error("Не удалось поставить лид в очередь для администратора: %s", e)
 
-        context.user_data["stage"] = "done"
+        set_stage(context, Stage.DONE)
         context.user_data["lead"] = lead
 
         await update.message.reply_text(
@@ -386,79 +781,85 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ----------------------------------------
     # ЭТАП 4 — ИМЯ
     # ----------------------------------------
-    if stage == "waiting_for_name":
+    if stage == Stage.WAITING_FOR_NAME:
         lead["name"] = text
         context.user_data["lead"] = lead
-        context.user_data["stage"] = "waiting_for_phone"
+        set_stage(context, Stage.WAITING_FOR_PHONE)
         await update.message.reply_text("Теперь номер телефона? 📱")
         return
 
     # ----------------------------------------
     # ЭТАП 3 — ПЛАТЁЖ + РАСЧЁТ СТАНЦИИ
     # ----------------------------------------
-    if stage == "waiting_for_bill":
+    if stage == Stage.WAITING_FOR_BILL:
         lead["bill"] = text
         context.user_data["lead"] = lead
-        context.user_data["stage"] = "waiting_for_name"
+        set_stage(context, Stage.WAITING_FOR_NAME)
 
-        # 1) наш инженерный черновой калькулятор
+        # 1) наш инженерный черновой калькулятор — сразу, он считается локально
         calc_text = calculate_solar_options(lead)
+        await update.message.reply_text(calc_text)
 
         # 2) комментарий от нейросети, как от «инженера-консультанта»
-        ai_comment = await ask_openai(
-            "Вот данные клиента и предварительный инженерный расчёт. "
-            "Аккуратно подтверди или скорректируй оценку, добавь 2–3 практичных совета. "
-            "Не проси повторно имя/телефон и не собирай данные ещё раз.\n\n"
-            f"Данные клиента: {json.dumps(lead, ensure_ascii=False)}\n\n"
-            f"Черновая оценка: {calc_text}"
-        )
+        #    (по нормализованным данным лида, поэтому обычно берётся из кэша).
+        #    Уже лежит в памяти — показываем по порядку, иначе догенерируем в фоне
+        key, _ = commentary_inputs(lead)
+        if commentary_cache is not None and key in commentary_cache:
+            await update.message.reply_text(await engineer_commentary(lead))
+        else:
+            run_in_background(deliver_commentary(update, context, lead), name="commentary")
 
-        await update.message.reply_text(calc_text)
-        await update.message.reply_text(ai_comment)
         await update.message.reply_text("Если всё в целом подходит — как тебя зовут? 🙂")
         return
 
     # ----------------------------------------
     # ЭТАП 2 — РЕГИОН
     # ----------------------------------------
-    if stage == "waiting_for_region":
+    if stage == Stage.WAITING_FOR_REGION:
         lead["region"] = text
         context.user_data["lead"] = lead
-        context.user_data["stage"] = "waiting_for_bill"
+        set_stage(context, Stage.WAITING_FOR_BILL)
         await update.message.reply_text("А сколько платите за электричество в месяц? 💡")
         return
 
     # ----------------------------------------
     # ЭТАП 1 — ТИП ОБЪЕКТА
     # ----------------------------------------
-    if stage == "waiting_for_object":
+    if stage == Stage.WAITING_FOR_OBJECT:
         lead["object"] = text
         context.user_data["lead"] = lead
-        context.user_data["stage"] = "waiting_for_region"
+        set_stage(context, Stage.WAITING_FOR_REGION)
         await update.message.reply_text("В каком регионе объект? 🗺️")
         return
 
     # ----------------------------------------
     # ЭТАП DONE — лид собран, дальше свободный ИИ-диалог
     # ----------------------------------------
-    if stage == "done":
-        reply = await ask_openai(text)
-        await update.message.reply_text(reply)
+    if stage == Stage.DONE:
+        canned = template_reply(detect_intents(text), allow_trigger=True)
+        if canned:
+            await reply_with_template(update, context, text, canned)
+            return
+
+        await reply_in_chat(update, context, text)
         return
 
     # ----------------------------------------
     # СВОБОДНЫЙ ЧАТ (начало) — stage == "chat"
     # ----------------------------------------
-    if stage == "chat":
+    if stage == Stage.CHAT:
+        intents = detect_intents(text)
+
+        # Приветствия, «дорого», «мало солнца» и т.п. — готовым ответом, без LLM
+        canned = template_reply(intents)
+        if canned:
+            await reply_with_template(update, context, text, canned)
+            return
+
         # Если человек говорит про дом, свет, счета → запуск сбора данных
-        triggers = [
-            "дом", "квартира", "дача", "коттедж",
-            "электричество", "свет", "квт", "кВт",
-            "счёт", "оплата", "энергия", "сэс", "солнечн",
-        ]
-
-        if any(word in text.lower() for word in triggers):
-            context.user_data["stage"] = "waiting_for_object"
+        if intents.trigger:
+            cancel_pending_reply(update)
+            set_stage(context, Stage.WAITING_FOR_OBJECT)
             context.user_data["lead"] = {}
             await update.message.reply_text(
                 "Вижу, тебя интересует тема света и счетов 🔆\n"
@@ -468,8 +869,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Иначе — обычный ИИ-ответ (болтовня, советы и т.д.)
-        reply = await ask_openai(text)
-        await update.message.reply_text(reply)
+        await reply_in_chat(update, context, text)
         return
 
 
@@ -477,18 +877,108 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ЗАПУСК
 # ===========================
 
+async def post_init(app: Application) -> None:
+    """Поднимаем долгоживущие ресурсы вместе с приложением."""
+    global llm, lead_store, commentary_cache, admin_outbox, metrics_server, coalescer, session_evictor, admission
+    # У каждого воркера webhook-режима свой порт метрик: METRICS_PORT + номер воркера
+    metrics_server = MetricsServer(METRICS_PORT + WORKER_SHARD if METRICS_PORT else 0)
+    await metrics_server.start()
+
+    llm = LLMRouter.from_env(OPENAI_API_KEY)
+    await llm.start()
+    coalescer = ChatCoalescer.from_env()
+    admission = AdmissionControl.from_env()
+
+    lead_store = create_lead_store()
+    await lead_store.start()
+    if WORKER_SHARD == 0:
+        await migrate_legacy_json(lead_store, LEADS_FILE)
+
+    # Очередь общая для всех воркеров, а разбирает её только нулевой:
+    # так лимиты Telegram на чат администратора соблюдаются глобально
+    admin_outbox = AdminOutbox.from_env()
+    await admin_outbox.start(app.bot if WORKER_SHARD == 0 else None)
+
+    commentary_cache = CommentaryCache.from_env()
+    await commentary_cache.start()
+
+    session_evictor = SessionEvictor.from_env(app)
+    await session_evictor.start()
+    if COMMENTARY_PREWARM > 0 and WORKER_SHARD == 0:
+        run_in_background(prewarm_commentary(COMMENTARY_PREWARM), name="commentary_prewarm")
+
+
+async def post_shutdown(app: Application) -> None:
+    """Закрываем пул соединений и прочие ресурсы."""
+    global llm, lead_store, commentary_cache, admin_outbox, metrics_server, coalescer, session_evictor, admission
+    if session_evictor is not None:
+        await session_evictor.close()
+        session_evictor = None
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    # Недоотвеченные пачки сообщений — до закрытия LLM-клиента
+    if coalescer is not None:
+        await coalescer.close()
+        coalescer = None
+
+    if commentary_cache is not None:
+        await commentary_cache.close()
+        commentary_cache = None
+    if admin_outbox is not None:
+        await admin_outbox.close()
+        admin_outbox = None
+    if llm is not None:
+        await llm.close()
+        llm = None
+    if lead_store is not None:
+        await lead_store.close()
+        lead_store = None
+    if admission is not None:
+        logger.info("Бюджет LLM: %s", admission.stats())
+        admission = None
+    if metrics_server is not None:
+        await metrics_server.close()
+        metrics_server = None
+
+
+def build_application(polling: bool = True, request: BaseRequest | None = None) -> Application:
+    """
+    Собрать Application с обработчиками. Без polling — для воркеров webhook-режима.
+    request — подменённый транспорт Bot API (нагрузочные тесты).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(SqliteUserDataPersistence.from_env())
+        # user_data — компактная Session вместо словаря (см. session.py)
+        .context_types(ContextTypes(user_data=Session))
+        .concurrent_updates(ChatOrderedUpdateProcessor.from_env())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)
+    # Время каждого запроса к Bot API — в метриках (пул как у ApplicationBuilder по умолчанию)
+    builder = builder.request(TimedRequest(request or HTTPXRequest(connection_pool_size=256)))
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
+
+
 def main():
     if not _ensure_config():
         return
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    if BOT_MODE == "webhook":
+        run_webhook(TELEGRAM_BOT_TOKEN)
+        return
 
+    app = build_application()
     app.run_polling()
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,185 @@
+"""
+Склейка сообщений, которые пользователь шлёт очередью в свободном чате.
+
+Люди часто разбивают одну мысль на три-четыре коротких сообщения подряд. Без склейки
+каждое уходит в LLM отдельным медленным запросом, а ответы получаются рваными.
+
+Текст чата копится в буфере, пока пользователь печатает. Генерация запускается,
+когда он молчит COALESCE_WINDOW секунд (но не позже COALESCE_MAX_WAIT от первого
+сообщения пачки), — один запрос на всю пачку. Пока ответ не начал показываться,
+новое сообщение отменяет генерацию и дописывается к пачке; после первого
+показанного текста ответ доводится до конца, а новые сообщения ждут следующего
+запроса. Всё это время в чате висит «печатает…».
+
+Обработчик апдейта не ждёт генерации: она идёт в фоновой задаче, поэтому
+очередь чата (ChatOrderedUpdateProcessor) успевает принять следующие сообщения.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable
+
+from metrics import COALESCED_MESSAGES, SUPERSEDED_GENERATIONS
+
+logger = logging.getLogger(__name__)
+
+# generate(prompt, commit): ответить на склеенный текст и вызвать commit()
+# перед тем, как пользователь увидит первый текст ответа
+Generate = Callable[[str, Callable[[], None]], Awaitable[None]]
+Typing = Callable[[], Awaitable[object]]
+
+
+class _Burst:
+    """Пачка сообщений одного чата и её фоновые задачи."""
+
+    __slots__ = ("texts", "first_at", "generate", "typing", "timer", "task", "committed", "typing_task")
+
+    def __init__(self):
+        self.texts: list[str] = []
+        self.first_at = 0.0
+        self.generate: Generate | None = None
+        self.typing: Typing | None = None
+        self.timer: asyncio.Task | None = None
+        self.task: asyncio.Task | None = None
+        self.committed = False
+        self.typing_task: asyncio.Task | None = None
+
+
+class ChatCoalescer:
+    def __init__(self, window: float = 1.2, max_wait: float = 4.0, typing_interval: float = 4.5):
+        self.window = window
+        self.max_wait = max_wait
+        # «печатает…» в Telegram гаснет через ~5 секунд — обновляем чуть чаще
+        self.typing_interval = typing_interval
+        self._bursts: dict[int, _Burst] = {}
+
+    @classmethod
+    def from_env(cls) -> "ChatCoalescer":
+        return cls(
+            window=float(os.getenv("COALESCE_WINDOW", "1.2")),
+            max_wait=float(os.getenv("COALESCE_MAX_WAIT", "4")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """COALESCE_WINDOW=0 — склейка выключена, отвечаем на каждое сообщение сразу."""
+        return self.window > 0
+
+    # ---------------------------
+    # Приём сообщений
+    # ---------------------------
+
+    def submit(self, chat_id: int, text: str, generate: Generate, typing: Typing) -> None:
+        """Добавить сообщение в пачку чата и (пере)запустить таймер тишины."""
+        loop = asyncio.get_running_loop()
+        burst = self._bursts.get(chat_id)
+        if burst is None:
+            burst = self._bursts[chat_id] = _Burst()
+        if not burst.texts:
+            burst.first_at = loop.time()
+        burst.texts.append(text)
+        # Отвечаем на последнее сообщение пачки
+        burst.generate, burst.typing = generate, typing
+
+        # Перебиваем генерацию, пока ответ не показан, — но не дольше max_wait,
+        # иначе того, кто пишет без пауз, бот не дождётся никогда
+        waited = loop.time() - burst.first_at
+        if burst.task is not None and not burst.committed and waited < self.max_wait:
+            burst.task.cancel()
+            SUPERSEDED_GENERATIONS.inc()
+
+        if burst.typing_task is None:
+            burst.typing_task = asyncio.create_task(self._typing_loop(burst))
+        if burst.timer is not None:
+            burst.timer.cancel()
+        delay = min(self.window, max(0.0, burst.first_at + self.max_wait - loop.time()))
+        burst.timer = asyncio.create_task(self._fire(chat_id, burst, delay))
+
+    def cancel(self, chat_id: int) -> None:
+        """Забыть несыгранную пачку (например, пользователь ушёл в воронку или нажал /start)."""
+        burst = self._bursts.pop(chat_id, None)
+        if burst is None:
+            return
+        burst.texts.clear()
+        if burst.timer is not None:
+            burst.timer.cancel()
+        if burst.task is not None and not burst.committed:
+            burst.task.cancel()
+        self._stop_typing(burst)
+
+    # ---------------------------
+    # Фоновые задачи
+    # ---------------------------
+
+    async def _typing_loop(self, burst: _Burst) -> None:
+        while True:
+            try:
+                await burst.typing()
+            except Exception as e:
+                logger.debug("Не удалось показать «печатает…»: %s", e)
+            await asyncio.sleep(self.typing_interval)
+
+    def _stop_typing(self, burst: _Burst) -> None:
+        if burst.typing_task is not None:
+            burst.typing_task.cancel()
+            burst.typing_task = None
+
+    async def _fire(self, chat_id: int, burst: _Burst, delay: float) -> None:
+        await asyncio.sleep(delay)
+        # Предыдущий ответ уже показывается — новая пачка уйдёт следом, не параллельно
+        if burst.task is not None:
+            await asyncio.wait({burst.task})
+        burst.timer = None
+        if not burst.texts:
+            self._forget(chat_id, burst)
+            return
+
+        count = len(burst.texts)
+        prompt = "\n".join(burst.texts)
+        burst.committed = False
+        burst.task = asyncio.create_task(self._run(chat_id, burst, prompt, count))
+
+    async def _run(self, chat_id: int, burst: _Burst, prompt: str, count: int) -> None:
+        def commit() -> None:
+            if burst.committed:
+                return
+            burst.committed = True
+            del burst.texts[:count]
+            # Сообщения, пришедшие за время генерации, — уже следующая пачка
+            burst.first_at = asyncio.get_running_loop().time()
+            self._stop_typing(burst)
+            if count > 1:
+                COALESCED_MESSAGES.inc(count)
+                logger.info("Склеено сообщений в один запрос: %s", count)
+
+        try:
+            await burst.generate(prompt, commit)
+        except asyncio.CancelledError:
+            # Перебили новым сообщением: текст остаётся в пачке и уйдёт вместе с ним
+            raise
+        except Exception:
+            logger.exception("Ошибка при ответе на склеенные сообщения")
+            # Не повторяем тот же запрос бесконечно
+            commit()
+        else:
+            commit()
+        finally:
+            if burst.task is asyncio.current_task():
+                burst.task = None
+            if not burst.texts and burst.timer is None:
+                self._forget(chat_id, burst)
+
+    def _forget(self, chat_id: int, burst: _Burst) -> None:
+        self._stop_typing(burst)
+        if self._bursts.get(chat_id) is burst:
+            del self._bursts[chat_id]
+
+    async def close(self) -> None:
+        tasks = []
+        for burst in self._bursts.values():
+            tasks += [t for t in (burst.timer, burst.task, burst.typing_task) if t is not None]
+        self._bursts.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,196 @@
+"""
+Кэш ответов модели для инженерного комментария на этапе waiting_for_bill.
+
+Ключ строится не по сырому тексту пользователя, а по нормализованным
+входам (категория объекта, регион, корзина счёта) — их собирает bot.py.
+
+— В памяти: LRU с ограничением по размеру и TTL записей.
+— На диске (необязательно): SQLite-таблица, переживает перезапуск.
+— Одновременные промахи по одному ключу ждут одну генерацию, а не запускают несколько.
+  Генерация идёт отдельной задачей: ожидающий, которого отменили (таймаут, /start),
+  просто отписывается, а остальные получают ответ, и он попадает в кэш.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class CommentaryCache:
+    def __init__(self, max_size: int = 512, ttl: float = 7 * 24 * 3600, disk_path: str | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_path = disk_path
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._items: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "CommentaryCache":
+        return cls(
+            max_size=int(os.getenv("COMMENTARY_CACHE_SIZE", "512")),
+            ttl=float(os.getenv("COMMENTARY_CACHE_TTL", str(7 * 24 * 3600))),
+            disk_path=os.getenv("COMMENTARY_CACHE_PATH", "commentary_cache.db") or None,
+        )
+
+    # ---------------------------
+    # Жизненный цикл
+    # ---------------------------
+
+    async def start(self) -> None:
+        if self.disk_path:
+            await asyncio.to_thread(self._open_disk)
+
+    async def close(self) -> None:
+        logger.info("Кэш комментариев: %s", self.stats())
+        tasks = list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    def stats(self) -> dict:
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / total, 3) if total else 0.0,
+        }
+
+    # ---------------------------
+    # Память (LRU + TTL)
+    # ---------------------------
+
+    def _get_memory(self, key: str) -> str | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        created_at, value = item
+        if time.time() - created_at > self.ttl:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def _put_memory(self, key: str, value: str, created_at: float) -> None:
+        self._items[key] = (created_at, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    # ---------------------------
+    # Диск (вызывается в потоке)
+    # ---------------------------
+
+    def _open_disk(self) -> None:
+        with self._lock:
+            self._conn = sqlite3.connect(self.disk_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS commentary ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            # Просроченное чистим сразу при старте
+            self._conn.execute(
+                "DELETE FROM commentary WHERE created_at < ?", (time.time() - self.ttl,)
+            )
+            self._conn.commit()
+
+    def _get_disk(self, key: str) -> tuple[float, str] | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_at, value FROM commentary WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def _put_disk(self, key: str, value: str, created_at: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO commentary (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, created_at),
+            )
+
+    # ---------------------------
+    # API
+    # ---------------------------
+
+    async def get(self, key: str) -> str | None:
+        value = self._get_memory(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        if self._conn is not None:
+            item = await asyncio.to_thread(self._get_disk, key)
+            if item is not None:
+                self.disk_hits += 1
+                self._put_memory(key, item[1], item[0])
+                return item[1]
+        return None
+
+    async def put(self, key: str, value: str) -> None:
+        created_at = time.time()
+        self._put_memory(key, value, created_at)
+        if self._conn is not None:
+            try:
+                await asyncio.to_thread(self._put_disk, key, value, created_at)
+            except sqlite3.Error as e:
+                logger.warning("Не удалось записать кэш комментариев на диск: %s", e)
+
+    def __contains__(self, key: str) -> bool:
+        return self._get_memory(key) is not None
+
+    async def get_or_create(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[str]],
+        cacheable: Callable[[str], bool] = bool,
+    ) -> str:
+        """Вернуть значение из кэша или сгенерировать его (одна генерация на ключ)."""
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._generate(key, factory, cacheable))
+            self._inflight[key] = task
+            # Исключение заберёт тот, кто ждал; если все отписались — не шумим в логах
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        # Отмена ожидающего не должна отменять генерацию, которую ждут другие
+        return await asyncio.shield(task)
+
+    async def _generate(
+        self, key: str, factory: Callable[[], Awaitable[str]], cacheable: Callable[[str], bool]
+    ) -> str:
+        try:
+            value = await factory()
+            if cacheable(value):
+                await self.put(key, value)
+            return value
+        finally:
+            del self._inflight[key]
@@ -0,0 +1,186 @@
+"""
+Черновой расчёт солнечной станции: один лид (для диалога) и целые массивы лидов
+(переоценка базы при смене тарифов или цен на оборудование).
+
+Скалярный и пакетный расчёт выполняют одни и те же операции с плавающей точкой
+в одном порядке, а округление до десятых в пакете повторяет round(x, 1)
+(см. _round1_batch). Поэтому результаты совпадают побитно, а не «примерно».
+"""
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from intents import object_category, parse_bill
+from regions import lookup_region, normalize_text, region_by_key, region_index
+
+# Категории объектов (как в intents.object_category)
+CATEGORIES = ("home", "country", "business")
+
+
+@dataclass(frozen=True, slots=True)
+class EstimateParams:
+    # Средний тариф, ₽/кВт⋅ч — если регион не распознан
+    tariff: float = 6.0
+    # Очень грубо: 1 кВт СЭС даёт ~110–130 кВт⋅ч/мес — если регион не распознан
+    kwh_per_kw: float = 120.0
+    # Тариф и выработку распознанного региона берём из справочника regions.json
+    regional: bool = True
+    # Примерный бюджет (диапазон) — 70–110 тыс ₽ за 1 кВт
+    cost_min_per_kw: float = 70000.0
+    cost_max_per_kw: float = 110000.0
+    min_power_kw: float = 1.0
+    # Тарифы отдельных регионов поверх справочника (ключ — normalize_region)
+    region_tariffs: dict[str, float] = field(default_factory=dict)
+    # Поправка к цене за кВт по категории объекта (коммерция дороже/дешевле)
+    category_cost_factor: dict[str, float] = field(default_factory=dict)
+
+    def tariff_for(self, region: str) -> float:
+        if region in self.region_tariffs:
+            return self.region_tariffs[region]
+        known = region_by_key(region) if self.regional else None
+        return known.tariff if known is not None else self.tariff
+
+    def yield_for(self, region: str) -> float:
+        known = region_by_key(region) if self.regional else None
+        return known.avg_yield if known is not None else self.kwh_per_kw
+
+    def tariff_table(self) -> dict[str, float]:
+        table = {r.key: r.tariff for r in region_index().regions} if self.regional else {}
+        return table | self.region_tariffs
+
+    def yield_table(self) -> dict[str, float]:
+        return {r.key: r.avg_yield for r in region_index().regions} if self.regional else {}
+
+
+DEFAULT_PARAMS = EstimateParams()
+
+
+@dataclass(slots=True)
+class Estimate:
+    power_kw: float
+    cost_min: int
+    cost_max: int
+    payback_years: float
+
+
+# Если сумму счёта не удалось разобрать («не помню»), считаем по типичной
+DEFAULT_BILL = 5000
+
+
+def lead_bill(lead: dict) -> int:
+    """Сумма счёта из ответа клиента («около 5 000 ₽», «пять тысяч» → 5000)."""
+    return parse_bill(lead.get("bill", "")) or DEFAULT_BILL
+
+
+def lead_category(lead: dict) -> str:
+    """Категория объекта для выбора типа станции: business / country / home."""
+    return object_category(lead.get("object", "") + " " + lead.get("region", ""))
+
+
+def normalize_region(region: str) -> str:
+    """Ключ региона из справочника («Подмосковье» → «московская область») или очищенный текст."""
+    known = lookup_region(region)
+    return known.key if known is not None else normalize_text(region)
+
+
+# ===========================
+# ОДИН ЛИД
+# ===========================
+
+def estimate(
+    bill: int, category: str = "home", region: str = "", params: EstimateParams = DEFAULT_PARAMS
+) -> Estimate:
+    """Мощность, бюджет и окупаемость по счёту за свет (region — ключ из normalize_region)."""
+    monthly_kwh = bill / params.tariff_for(region)
+
+    power_kw = round(monthly_kwh / params.yield_for(region), 1)
+    if power_kw < params.min_power_kw:
+        power_kw = params.min_power_kw
+
+    factor = params.category_cost_factor.get(category, 1.0)
+    cost_min = int(power_kw * (params.cost_min_per_kw * factor))
+    cost_max = int(power_kw * (params.cost_max_per_kw * factor))
+
+    avg_cost = (cost_min + cost_max) / 2
+    payback_years = round(avg_cost / (bill * 12), 1)
+    return Estimate(power_kw, cost_min, cost_max, payback_years)
+
+
+# ===========================
+# МАССИВЫ ЛИДОВ
+# ===========================
+
+@dataclass(slots=True)
+class BatchEstimate:
+    power_kw: np.ndarray
+    cost_min: np.ndarray
+    cost_max: np.ndarray
+    payback_years: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.power_kw)
+
+    def row(self, i: int) -> Estimate:
+        return Estimate(
+            float(self.power_kw[i]), int(self.cost_min[i]), int(self.cost_max[i]),
+            float(self.payback_years[i]),
+        )
+
+
+def _lookup(keys: np.ndarray, table: dict[str, float], default: float) -> np.ndarray:
+    """Значение из словаря для каждого элемента: np.unique + обратный индекс, без цикла по строкам."""
+    if not table:
+        return np.full(len(keys), default)
+    uniques, inverse = np.unique(keys, return_inverse=True)
+    values = np.array([table.get(k, default) for k in uniques.tolist()], dtype=np.float64)
+    return values[inverse]
+
+
+def _round1_batch(values: np.ndarray) -> np.ndarray:
+    """
+    round(x, 1) для массива. np.round умножает на 10 и теряет точность на «половинках»:
+    1.05 хранится как 1.0500000000000000444, round даёт 1.1, а 1.05 * 10 == 10.5 → 10.
+    Такие редкие элементы досчитываем встроенным round.
+    """
+    scaled = values * 10
+    result = np.rint(scaled) / 10
+    ties = np.nonzero(scaled - np.floor(scaled) == 0.5)[0]
+    if len(ties):
+        result[ties] = [round(v, 1) for v in values[ties].tolist()]
+    return result
+
+
+def estimate_batch(
+    bills: np.ndarray,
+    categories: np.ndarray | None = None,
+    regions: np.ndarray | None = None,
+    params: EstimateParams = DEFAULT_PARAMS,
+) -> BatchEstimate:
+    """
+    То же, что estimate(), для массивов: bills — счета в ₽/мес, categories — строки
+    из CATEGORIES, regions — ключи из normalize_region. Один проход без Python-цикла по лидам.
+    """
+    bills = np.asarray(bills, dtype=np.float64)
+    n = len(bills)
+    if categories is None:
+        categories = np.full(n, "home")
+    if regions is None:
+        regions = np.full(n, "")
+
+    regions = np.asarray(regions, dtype=str)
+    tariffs = _lookup(regions, params.tariff_table(), params.tariff)
+    yields = _lookup(regions, params.yield_table(), params.kwh_per_kw)
+    factors = _lookup(np.asarray(categories, dtype=str), params.category_cost_factor, 1.0)
+
+    monthly_kwh = bills / tariffs
+    power_kw = _round1_batch(monthly_kwh / yields)
+    power_kw = np.where(power_kw < params.min_power_kw, params.min_power_kw, power_kw)
+
+    # int() в скалярном пути отбрасывает дробную часть — astype делает то же для положительных
+    cost_min = (power_kw * (params.cost_min_per_kw * factors)).astype(np.int64)
+    cost_max = (power_kw * (params.cost_max_per_kw * factors)).astype(np.int64)
+
+    avg_cost = (cost_min + cost_max) / 2
+    payback_years = _round1_batch(avg_cost / (bills * 12))
+    return BatchEstimate(power_kw, cost_min, cost_max, payback_years)
@@ -0,0 +1,264 @@
+"""
+Локальный разбор сообщений без обращения к LLM.
+
+— Намерения (старт воронки, приветствие, классические возражения, частые вопросы)
+  ищутся одним заранее скомпилированным регулярным выражением: по группе на
+  намерение, внутри — основы слов (дорог → дорого, дороговато, дорогая…).
+— Если сообщение целиком «покрыто» найденным намерением (уверенность высокая),
+  отвечаем готовым шаблоном; иначе решение остаётся за моделью.
+— Сущности: телефон (нормализуем к +7XXXXXXXXXX), сумма счёта
+  (в том числе словами: «около пяти тысяч»), категория объекта.
+"""
+
+import random
+import re
+from dataclasses import dataclass, field
+
+# ===========================
+# НАМЕРЕНИЯ
+# ===========================
+
+# Основы слов: совпадение с начала слова, окончание любое.
+# Многословные фразы пишутся через пробел — между словами допускаются любые пробелы/знаки.
+# Короткие и многозначные основы — с явными окончаниями или (?!\w) в конце:
+# иначе «хайп» — приветствие, а «Дорогой домовой!» — возражение «дорого».
+INTENT_STEMS: dict[str, list[str]] = {
+    # интерес к теме — запускает сбор данных (как старый список triggers)
+    "trigger": [
+        "дом(?!ов(?:ой|ого|ому|ым|ом|ые|ых)\\b)", "квартир", "дач", "коттедж",
+        "электричеств", "свет", "квт", "сч[её]т", "оплат", "энерги", "сэс", "солнечн",
+    ],
+    "greeting": [
+        "привет", "здравству", "здрасьте", "добр(?:ый|ое|ого) (?:день|утр|вечер)",
+        "хай(?!\\w)", "салют(?!\\w)",
+    ],
+    "thanks": ["спасибо", "благодар", "спс"],
+    "objection_expensive": [
+        # «дорога» (путь) и обращение «дорогой домовой/друг» — не про цену
+        "дорог(?:о|оват\\w*|овизн\\w*|ущ\\w*|ие|их|ими|ую|ое|ая|ой|ого|ому)(?!\\w)"
+        "(?!\\s+(?:мой\\s+|наш\\s+)?(?:домов|друг|бот))",
+        "не потян", "нет денег", "денег нет", "не по карману", "слишком много стоит",
+    ],
+    "objection_little_sun": [
+        "мало солнц", "солнца мало", "нет солнц", "солнца нет", "не хватит солнц",
+        "пасмурн", "облачн",
+    ],
+    "objection_outage": ["отключ", "пропад(?:ет|[её]т) свет", "блэкаут", "нет света"],
+    "objection_breakage": ["слома", "полома", "поломк", "выйд(?:ет|[её]т) из строя"],
+    "faq_why": ["зачем мне", "зачем это", "какой смысл", "в ч[её]м смысл"],
+    "faq_payback": ["окупа", "когда отоб", "за сколько отоб"],
+    "faq_warranty": ["гаранти", "сколько служ", "срок служб"],
+}
+
+# Слова, которые не несут смысла и не снижают уверенность («это же дорого»)
+FILLER_WORDS = frozenset(
+    "а и но же ну это так вот у нас вас мне нам меня если ли что как а вдруг "
+    "очень слишком всё все всего ведь уж да нет ой эх хм просто кстати вообще "
+    "ваш ваша ваше ваши у вас у меня тут там здесь же ж бы то домовой домовенок бот".split()
+)
+
+# Намерения, на которые есть готовый ответ
+TEMPLATES: dict[str, list[str]] = {
+    "greeting": [
+        "Привет! Я Домовой Дом Солнца ☀️ Можем поболтать или прикинуть солнечную станцию "
+        "для вашего дома — с чего начнём?",
+    ],
+    "thanks": [
+        "Всегда пожалуйста! Солнце не присылает счета — и я тоже 😉 Если появятся вопросы — пишите.",
+    ],
+    "objection_expensive": [
+        "Дорого — это платить всю жизнь. Станция — это наоборот инвестиция, которая начинает "
+        "отбиваться в первый же месяц. Солнце не присылает счета ☀️\n"
+        "Хотите, прикину, во что обойдётся станция именно для вашего дома?",
+    ],
+    "objection_little_sun": [
+        "Это миф. Даже в Подмосковье солнца больше, чем в Германии, где солнечные станции "
+        "стоят на каждом доме 🌤\nМогу прикинуть выработку для вашего региона — интересно?",
+    ],
+    "objection_outage": [
+        "Вот именно! Гибридная СЭС — это как иметь запасной двигатель на ракете: даже если "
+        "сеть упала, вы работаете дальше 🚀\nРассказать, какая станция подойдёт вашему дому?",
+    ],
+    "objection_breakage": [
+        "Фотопанели — как кирпичи. Просто лежат и 25 лет генерируют. Ломаться там практически "
+        "нечему 🧱☀️\nХотите прикинуть станцию под ваш объект?",
+    ],
+    "faq_why": [
+        "Чтобы платить меньше, жить автономнее и чувствовать себя человеком будущего. "
+        "Пока соседи ругаются на тарифы, вы тихо заряжаетесь от солнца ⚡",
+    ],
+}
+
+INTENT_MIN_CONFIDENCE = 0.8
+
+
+def _stem_pattern(stem: str) -> str:
+    return r"[\s,.!?-]+".join(stem.split(" "))
+
+
+# \b и хвост \w* вынесены за скобки: движок проверяет альтернативы только с начала слова
+_INTENT_RE = re.compile(
+    r"\b(?:"
+    + "|".join(
+        f"(?P<{name}>{'|'.join(_stem_pattern(s) for s in stems)})"
+        for name, stems in INTENT_STEMS.items()
+    )
+    + r")\w*",
+)
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+@dataclass(slots=True)
+class IntentMatch:
+    intents: set[str] = field(default_factory=set)
+    # Доля слов сообщения, объяснённых найденными намерениями или словами-связками
+    confidence: float = 0.0
+
+    @property
+    def trigger(self) -> bool:
+        return "trigger" in self.intents
+
+    @property
+    def answerable(self) -> str | None:
+        """Намерение, на которое можно ответить шаблоном (если оно одно)."""
+        candidates = [i for i in self.intents if i in TEMPLATES]
+        return candidates[0] if len(candidates) == 1 else None
+
+
+def detect_intents(text: str) -> IntentMatch:
+    text = normalize(text)
+    words = _WORD_RE.findall(text)
+    if not words:
+        return IntentMatch()
+
+    intents = set()
+    covered = 0
+    for m in _INTENT_RE.finditer(text):
+        intents.add(m.lastgroup)
+        covered += len(_WORD_RE.findall(m.group()))
+
+    covered += sum(1 for w in words if w in FILLER_WORDS)
+    return IntentMatch(intents, min(1.0, covered / len(words)))
+
+
+def template_reply(match: IntentMatch, allow_trigger: bool = False) -> str | None:
+    """
+    Готовый ответ, если сообщение уверенно распознано; иначе None.
+    allow_trigger=False — не отвечать шаблоном на сообщение, которое должно запускать воронку:
+    «у нас дорогое электричество» — это не возражение, а повод сразу перейти к расчёту.
+    """
+    intent = match.answerable
+    if intent is None or match.confidence < INTENT_MIN_CONFIDENCE:
+        return None
+    if match.trigger and not allow_trigger:
+        return None
+    return random.choice(TEMPLATES[intent])
+
+
+# ===========================
+# ТЕЛЕФОН
+# ===========================
+
+# С префиксом +7/8 — любой код (городские тоже), без префикса — только мобильный 9xx
+_PHONE_RE = re.compile(
+    r"(?<!\d)(?:(?:\+?7|8)[\s\-]*\(?(?P<code>\d{3})\)?|\(?(?P<mobile>9\d{2})\)?)"
+    r"[\s\-]*(\d{3})[\s\-]*(\d{2})[\s\-]*(\d{2})(?!\d)"
+)
+
+
+def parse_phone(text: str) -> str | None:
+    """Российский номер в виде +7XXXXXXXXXX или None."""
+    m = _PHONE_RE.search(text)
+    if not m:
+        return None
+    code, mobile, *rest = m.groups()
+    return "+7" + (code or mobile) + "".join(rest)
+
+
+# ===========================
+# СУММА СЧЁТА
+# ===========================
+
+_NUMBER_WORDS = {
+    "ноль": 0, "один": 1, "одна": 1, "одну": 1, "два": 2, "две": 2, "пара": 2, "пару": 2,
+    "три": 3, "четыре": 4, "пять": 5, "шесть": 6, "семь": 7, "восемь": 8, "девять": 9,
+    "десять": 10, "одиннадцать": 11, "двенадцать": 12, "пятнадцать": 15, "двадцать": 20,
+    "тридцать": 30, "сорок": 40, "пятьдесят": 50, "сто": 100, "двести": 200,
+    "триста": 300, "пятьсот": 500,
+    "полтора": 1.5, "полторы": 1.5,
+    # родительный падеж: «около пяти тысяч»
+    "одного": 1, "двух": 2, "трех": 3, "четырех": 4, "пяти": 5, "шести": 6, "семи": 7,
+    "восьми": 8, "девяти": 9, "десяти": 10, "пятнадцати": 15, "двадцати": 20,
+    "тридцати": 30, "сорока": 40, "пятидесяти": 50, "полутора": 1.5,
+}
+
+_THOUSAND_RE = r"(?:тыс\w*|т\.?\s?р\.?|к|k|тыщ\w*|тыш\w*)"
+_NUM_RE = r"\d{1,3}(?:\s\d{3})+(?!\d)|\d+(?:[.,]\d+)?"
+
+_BILL_DIGITS_RE = re.compile(
+    rf"(?P<a>{_NUM_RE})(?:\s*(?:-|–|до)\s*(?P<b>{_NUM_RE}))?\s*(?P<k>{_THOUSAND_RE}(?!\w))?",
+    re.IGNORECASE,
+)
+_BILL_WORDS_RE = re.compile(
+    rf"\b(?P<n>(?:{'|'.join(sorted(_NUMBER_WORDS, key=len, reverse=True))})"
+    rf"(?:\s+(?:{'|'.join(sorted(_NUMBER_WORDS, key=len, reverse=True))}))?)\s+(?P<k>{_THOUSAND_RE})?",
+    re.IGNORECASE,
+)
+
+
+def _to_number(raw: str) -> float:
+    return float(raw.replace(" ", "").replace(",", "."))
+
+
+def parse_bill(text: str) -> int | None:
+    """Сумма счёта в рублях из свободного текста или None.
+
+    «5000», «5 000 ₽», «5к», «4-5 тыс» (берём середину), «около пяти тысяч», «полторы тыщи».
+    """
+    text = normalize(text)
+
+    m = _BILL_DIGITS_RE.search(text)
+    if m:
+        value = _to_number(m.group("a"))
+        if m.group("b"):
+            value = (value + _to_number(m.group("b"))) / 2
+        # «5 тыс», а также «5» без единиц — явно тысячи, а не рубли
+        if m.group("k") or value < 100:
+            value *= 1000
+        return int(value)
+
+    m = _BILL_WORDS_RE.search(text + " ")
+    if m:
+        value = sum(_NUMBER_WORDS[w] for w in m.group("n").split())
+        if m.group("k") or value < 100:
+            value *= 1000
+        return int(value)
+
+    if re.search(r"\bтыс", text):
+        return 1000  # «тысячу в месяц»
+    return None
+
+
+# ===========================
+# КАТЕГОРИЯ ОБЪЕКТА
+# ===========================
+
+# Коммерческие объекты проверяем первыми: «магазин в селе» — это всё равно бизнес
+_BUSINESS_RE = re.compile(r"\b(?:производ|завод|цех|магазин|склад|бизнес|офис|кафе)\w*")
+_COUNTRY_RE = re.compile(
+    r"\b(?:дач|дерев|сел(?:о|а|е|у|ом|ьск)|посел|пос[её]лк|снт|хутор|ферм)\w*"
+)
+
+
+def object_category(text: str) -> str:
+    """Категория объекта: business / country / home."""
+    text = normalize(text)
+    if _BUSINESS_RE.search(text):
+        return "business"
+    if _COUNTRY_RE.search(text):
+        return "country"
+    return "home"
@@ -0,0 +1,375 @@
+"""
+Хранилище лидов.
+
+Раньше save_lead каждый раз читал и переписывал весь leads.json прямо
+в event loop. Здесь запись идёт в фоне: save() кладёт лид в очередь,
+отдельная задача забирает всё, что накопилось, и пишет пачкой в потоке
+(asyncio.to_thread). save() возвращается, когда пачка с этим лидом
+записана на диск — лид не теряется, а event loop не блокируется.
+
+Бэкенды:
+— JsonlLeadStore: append-only журнал leads.jsonl + индекс user_id → смещение
+  в памяти, периодическое сжатие (compaction) журнала;
+— SqliteLeadStore: SQLite в режиме WAL.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+# Сколько лидов максимум пишем за одну пачку
+BATCH_SIZE = 256
+
+
+class LeadStore:
+    """Базовый класс: очередь + фоновый писатель. Наследники реализуют _write_batch и чтение."""
+
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._writer: asyncio.Task | None = None
+
+    # ---------------------------
+    # Жизненный цикл
+    # ---------------------------
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self._open)
+        self._queue = asyncio.Queue()
+        self._writer = asyncio.create_task(self._write_loop(), name="lead_store_writer")
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            await self._queue.put(None)
+            await self._writer
+            self._writer = None
+        await asyncio.to_thread(self._close)
+
+    # ---------------------------
+    # API
+    # ---------------------------
+
+    async def save(self, user_id: str, lead: dict) -> None:
+        """Записать лид (последний лид пользователя перезаписывает предыдущий)."""
+        if self._queue is None:
+            raise RuntimeError("Хранилище лидов не запущено: вызовите start()")
+
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put((str(user_id), dict(lead), done))
+        await done
+
+    async def get(self, user_id: str) -> dict | None:
+        return await asyncio.to_thread(self._get, str(user_id))
+
+    def iter_leads(self) -> Iterator[tuple[str, dict]]:
+        """Синхронный обход всех лидов (для офлайн-скриптов)."""
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    # ---------------------------
+    # Фоновая запись
+    # ---------------------------
+
+    async def _write_loop(self) -> None:
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            batch = []
+            if item is None:
+                stopping = True
+            else:
+                batch.append(item)
+
+            # Забираем всё, что успело накопиться, пока писалась прошлая пачка
+            while len(batch) < BATCH_SIZE and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    continue
+                batch.append(item)
+
+            if not batch:
+                continue
+
+            try:
+                await asyncio.to_thread(self._write_batch, [(uid, lead) for uid, lead, _ in batch])
+            except Exception as e:
+                logger.error("Не удалось сохранить %s лид(ов): %s", len(batch), e)
+                for _, _, done in batch:
+                    if not done.done():
+                        done.set_exception(e)
+                continue
+
+            for _, _, done in batch:
+                if not done.done():
+                    done.set_result(None)
+
+    # ---------------------------
+    # Реализация бэкенда (вызывается в потоке)
+    # ---------------------------
+
+    def _open(self) -> None:
+        raise NotImplementedError
+
+    def _close(self) -> None:
+        raise NotImplementedError
+
+    def _write_batch(self, batch: list[tuple[str, dict]]) -> None:
+        raise NotImplementedError
+
+    def _get(self, user_id: str) -> dict | None:
+        raise NotImplementedError
+
+
+class JsonlLeadStore(LeadStore):
+    """
+    Append-only журнал: одна строка JSON на сохранение.
+    В памяти держим только user_id → смещение последней записи в файле.
+    """
+
+    def __init__(self, path: str = "leads.jsonl", compact_ratio: float = 2.0):
+        super().__init__()
+        self.path = path
+        # Сжимаем журнал, когда строк в нём в compact_ratio раз больше, чем живых лидов
+        self.compact_ratio = compact_ratio
+        self._index: dict[str, int] = {}
+        self._records = 0
+        self._lock = threading.Lock()
+        self._fh = None
+
+    def _open(self) -> None:
+        with self._lock:
+            self._rebuild_index(repair=True)
+            self._fh = open(self.path, "ab")
+
+    def _close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def _rebuild_index(self, repair: bool = False) -> None:
+        """
+        Перечитать журнал. Недописанную последнюю строку читатель просто пропускает
+        (её, возможно, как раз дописывает работающий бот), а писатель (repair=True,
+        из _open) обрезает: иначе следующая запись приклеится к ней и пропадёт.
+        """
+        self._index.clear()
+        self._records = 0
+        if not os.path.exists(self.path):
+            return
+
+        torn = None
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    torn = offset
+                    break
+                try:
+                    record = json.loads(line)
+                    self._index[str(record["user_id"])] = offset
+                    self._records += 1
+                except (json.JSONDecodeError, KeyError):
+                    logger.warning("Пропущена битая строка в %s (смещение %s)", self.path, offset)
+                offset += len(line)
+
+        if torn is not None and repair:
+            logger.warning("Обрезана недописанная строка в конце %s (смещение %s)", self.path, torn)
+            with open(self.path, "r+b") as f:
+                f.truncate(torn)
+
+    def _write_batch(self, batch: list[tuple[str, dict]]) -> None:
+        with self._lock:
+            offset = self._fh.tell()
+            chunks = []
+            for user_id, lead in batch:
+                line = json.dumps({"user_id": user_id, "lead": lead}, ensure_ascii=False) + "\n"
+                data = line.encode("utf-8")
+                chunks.append(data)
+                self._index[user_id] = offset
+                offset += len(data)
+
+            self._fh.write(b"".join(chunks))
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._records += len(batch)
+
+            if self._records > max(64, len(self._index) * self.compact_ratio):
+                self._compact()
+
+    def _compact(self) -> None:
+        """Переписать журнал, оставив только последнюю запись каждого пользователя."""
+        tmp_path = self.path + ".compact"
+        new_index: dict[str, int] = {}
+
+        self._fh.close()
+        with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+            for user_id, offset in self._index.items():
+                src.seek(offset)
+                line = src.readline()
+                new_index[user_id] = dst.tell()
+                dst.write(line)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        os.replace(tmp_path, self.path)
+        self._index = new_index
+        self._records = len(new_index)
+        self._fh = open(self.path, "ab")
+        logger.info("Журнал лидов сжат: %s записей", self._records)
+
+    def _read_at(self, offset: int) -> dict:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())["lead"]
+
+    def _get(self, user_id: str) -> dict | None:
+        with self._lock:
+            offset = self._index.get(user_id)
+            if offset is None:
+                return None
+            return self._read_at(offset)
+
+    def iter_leads(self) -> Iterator[tuple[str, dict]]:
+        if not self._index and os.path.exists(self.path):
+            self._rebuild_index()
+        # Читаем журнал последовательно и отдаём только актуальные записи
+        with self._lock:
+            wanted = {offset: user_id for user_id, offset in self._index.items()}
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                user_id = wanted.get(offset)
+                if user_id is not None:
+                    yield user_id, json.loads(line)["lead"]
+                offset += len(line)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class SqliteLeadStore(LeadStore):
+    """SQLite в режиме WAL: одна строка на пользователя, upsert пачкой в одной транзакции."""
+
+    def __init__(self, path: str = "leads.db"):
+        super().__init__()
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> None:
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leads ("
+                " user_id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+            )
+            self._conn.commit()
+
+    def _close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _write_batch(self, batch: list[tuple[str, dict]]) -> None:
+        rows = [(user_id, json.dumps(lead, ensure_ascii=False)) for user_id, lead in batch]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO leads (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET "
+                "data = excluded.data, updated_at = CURRENT_TIMESTAMP",
+                rows,
+            )
+
+    def _get(self, user_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM leads WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_leads(self) -> Iterator[tuple[str, dict]]:
+        conn = sqlite3.connect(self.path)
+        try:
+            for user_id, data in conn.execute("SELECT user_id, data FROM leads"):
+                yield user_id, json.loads(data)
+        finally:
+            conn.close()
+
+    def __len__(self) -> int:
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+        finally:
+            conn.close()
+
+
+# ===========================
+# ФАБРИКА И МИГРАЦИЯ
+# ===========================
+
+def create_lead_store(backend: str | None = None, path: str | None = None) -> LeadStore:
+    """Выбрать бэкенд по LEAD_STORE (jsonl | sqlite) и LEAD_STORE_PATH."""
+    backend = (backend or os.getenv("LEAD_STORE", "jsonl")).lower()
+    path = path or os.getenv("LEAD_STORE_PATH")
+
+    if backend == "sqlite":
+        return SqliteLeadStore(path or "leads.db")
+    if backend != "jsonl":
+        logger.warning("Неизвестный LEAD_STORE=%s, используем jsonl", backend)
+    return JsonlLeadStore(path or "leads.jsonl")
+
+
+async def migrate_legacy_json(store: LeadStore, legacy_path: str = "leads.json") -> int:
+    """
+    Разовый перенос лидов из старого leads.json.
+    После успешного переноса файл переименовывается в leads.json.migrated,
+    поэтому повторный запуск ничего не делает.
+    """
+    if not os.path.exists(legacy_path):
+        return 0
+
+    def _load() -> dict:
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                logger.error("Старый %s повреждён, миграция пропущена", legacy_path)
+                return {}
+
+    legacy = await asyncio.to_thread(_load)
+    if not legacy:
+        return 0
+
+    await asyncio.gather(*(store.save(user_id, lead) for user_id, lead in legacy.items()))
+    await asyncio.to_thread(os.replace, legacy_path, legacy_path + ".migrated")
+    logger.info("Перенесено %s лид(ов) из %s", len(legacy), legacy_path)
+    return len(legacy)
+
+
+async def migrate_jsonl(store: LeadStore, jsonl_path: str = "leads.jsonl") -> int:
+    """
+    Разовый перенос журнала leads.jsonl в другое хранилище (при переходе на sqlite).
+    После переноса журнал переименовывается в leads.jsonl.migrated.
+    """
+    if not os.path.exists(jsonl_path):
+        return 0
+
+    leads = await asyncio.to_thread(lambda: list(JsonlLeadStore(jsonl_path).iter_leads()))
+    await asyncio.gather(*(store.save(user_id, lead) for user_id, lead in leads))
+    await asyncio.to_thread(os.replace, jsonl_path, jsonl_path + ".migrated")
+    logger.info("Перенесено %s лид(ов) из %s", len(leads), jsonl_path)
+    return len(leads)
@@ -0,0 +1,269 @@
+"""
+Долгоживущий HTTP-клиент к LLM (OpenAI Responses API).
+
+Одна aiohttp-сессия с пулом keep-alive соединений на всё время жизни
+Application, ограничение числа одновременных запросов, таймауты
+на подключение/чтение и повторы с джиттером на 429/5xx.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+from typing import AsyncIterator
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Статусы, которые имеет смысл повторить: лимиты и временные сбои на стороне API
+RETRY_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+class LLMError(Exception):
+    """Запрос к LLM не удался (после всех повторов)."""
+
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+# Сбои транспорта и разбора ответа, которые превращаем в LLMError: обрыв соединения
+# или тела посреди чтения (ClientPayloadError), не-JSON в ответе 200
+# (ContentTypeError, JSONDecodeError — это ValueError), битый UTF-8 в стриме
+_TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        logger.warning("Переменная %s должна быть целым числом, используем %s", name, default)
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logger.warning("Переменная %s должна быть числом, используем %s", name, default)
+        return default
+
+
+def extract_output_text(data: dict) -> str:
+    """Вытащить текст ответа из тела Responses API (поля зависят от формата ответа)."""
+    text = data.get("output_text")
+    if text:
+        return text
+
+    parts = []
+    for item in data.get("output", []):
+        for c in item.get("content", []) or []:
+            if c.get("type") in ("output_text", "text"):
+                parts.append(c.get("text", ""))
+    return "".join(parts)
+
+
+class LLMClient:
+    """
+    Клиент к /v1/responses с общим пулом соединений.
+
+    Сессия создаётся в start() и закрывается в close() — их вызывают
+    post_init / post_shutdown приложения.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = "https://api.openai.com/v1",
+        max_concurrency: int = 8,
+        pool_size: int = 32,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 60.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: aiohttp.ClientSession | None = None
+
+    @classmethod
+    def from_env(
+        cls,
+        api_key: str,
+        prefix: str = "OPENAI",
+        default_base_url: str = "https://api.openai.com/v1",
+    ) -> "LLMClient":
+        """Собрать клиент из переменных окружения {prefix}_* (все необязательные)."""
+        return cls(
+            api_key=api_key,
+            base_url=os.getenv(f"{prefix}_BASE_URL", default_base_url),
+            max_concurrency=_env_int(f"{prefix}_MAX_CONCURRENCY", 8),
+            pool_size=_env_int(f"{prefix}_POOL_SIZE", 32),
+            connect_timeout=_env_float(f"{prefix}_CONNECT_TIMEOUT", 5.0),
+            read_timeout=_env_float(f"{prefix}_READ_TIMEOUT", 60.0),
+            max_retries=_env_int(f"{prefix}_MAX_RETRIES", 3),
+        )
+
+    # ---------------------------
+    # Жизненный цикл
+    # ---------------------------
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=self.connect_timeout,
+            sock_read=self.read_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            },
+        )
+        logger.info(
+            "LLM-клиент запущен: %s, до %s запросов одновременно",
+            self.base_url, self.max_concurrency,
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise LLMError("LLM-клиент не запущен: вызовите start()")
+        return self._session
+
+    # ---------------------------
+    # Запросы
+    # ---------------------------
+
+    def _backoff(self, attempt: int, retry_after: str | None = None) -> float:
+        """Пауза перед повтором: Retry-After от сервера или экспонента с full jitter."""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        cap = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    async def create_response(self, payload: dict) -> dict:
+        """POST /responses с повторами. Возвращает JSON ответа или бросает LLMError."""
+        url = f"{self.base_url}/responses"
+        last_error: LLMError | None = None
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    async with self.session.post(url, json=payload) as resp:
+                        if resp.status == 200:
+                            return await resp.json()
+
+                        body = await resp.text()
+                        last_error = LLMError(body, status=resp.status)
+                        if resp.status not in RETRY_STATUSES:
+                            raise last_error
+                        retry_after = resp.headers.get("Retry-After")
+            except _TRANSPORT_ERRORS as e:
+                last_error = LLMError(f"{type(e).__name__}: {e}")
+
+            if attempt < self.max_retries:
+                delay = self._backoff(attempt, retry_after)
+                logger.warning(
+                    "LLM-запрос не удался (%s), повтор %s/%s через %.2f с",
+                    last_error.status or last_error, attempt + 1, self.max_retries, delay,
+                )
+                await asyncio.sleep(delay)
+
+        raise last_error
+
+    async def stream_response(self, payload: dict) -> AsyncIterator[dict]:
+        """
+        POST /responses со stream=true: отдаёт события server-sent events по одному.
+
+        Повторы делаются только до получения первого события — дальше
+        часть текста уже ушла пользователю, и повтор дал бы дубли.
+        """
+        url = f"{self.base_url}/responses"
+        payload = {**payload, "stream": True}
+        last_error: LLMError | None = None
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            started = False
+            try:
+                async with self._semaphore:
+                    async with self.session.post(url, json=payload) as resp:
+                        if resp.status == 200:
+                            async for event in _iter_sse(resp.content):
+                                started = True
+                                yield event
+                            return
+
+                        body = await resp.text()
+                        last_error = LLMError(body, status=resp.status)
+                        if resp.status not in RETRY_STATUSES:
+                            raise last_error
+                        retry_after = resp.headers.get("Retry-After")
+            except _TRANSPORT_ERRORS as e:
+                last_error = LLMError(f"{type(e).__name__}: {e}")
+                if started:
+                    raise last_error from e
+
+            if attempt < self.max_retries:
+                delay = self._backoff(attempt, retry_after)
+                logger.warning(
+                    "LLM-стрим не удался (%s), повтор %s/%s через %.2f с",
+                    last_error.status or last_error, attempt + 1, self.max_retries, delay,
+                )
+                await asyncio.sleep(delay)
+
+        raise last_error
+
+
+async def _iter_sse(content: aiohttp.StreamReader) -> AsyncIterator[dict]:
+    """Разобрать поток text/event-stream в JSON-события (поле data)."""
+    data_lines: list[str] = []
+    async for raw in content:
+        line = raw.decode("utf-8").rstrip("\r\n")
+        if line.startswith("data:"):
+            data_lines.append(line[5:].lstrip())
+            continue
+        if line or not data_lines:
+            # event:/id:/комментарии не нужны — тип события есть внутри data
+            continue
+
+        data = "\n".join(data_lines)
+        data_lines = []
+        if data == "[DONE]":
+            return
+        try:
+            yield json.loads(data)
+        except json.JSONDecodeError:
+            logger.warning("Не удалось разобрать SSE-событие: %s", data[:200])
@@ -0,0 +1,432 @@
+"""
+Маршрутизация запросов к нескольким LLM-провайдерам (OpenAI и любые
+OpenAI-совместимые эндпоинты с Responses API, например Groq).
+
+— Провайдеры перечислены в LLM_PROVIDERS по приоритету, у каждого свой LLMClient
+  (переменные {ИМЯ}_API_KEY, {ИМЯ}_BASE_URL, {ИМЯ}_MODEL, {ИМЯ}_MAX_RETRIES, …).
+— Хеджирование: если основной провайдер не ответил за своё наблюдаемое p90
+  (для стрима — p90 времени до первого куска текста), параллельно уходит запрос
+  к следующему, побеждает тот, кто ответит первым; второй отменяется.
+— Автоматический выключатель (circuit breaker) на провайдера: после серии сбоев
+  провайдер выводится из ротации на LLM_BREAKER_COOLDOWN секунд, затем получает
+  один пробный запрос.
+
+Интерфейс тот же, что у LLMClient (start/close/create_response/stream_response),
+поле model в запросе подменяется моделью провайдера.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncIterator
+
+from llm_client import RETRY_STATUSES, LLMClient, LLMError, _env_float, _env_int
+from metrics import LLM_HEDGES, LLM_PROVIDER_REQUESTS, LLM_PROVIDER_STATE
+
+logger = logging.getLogger(__name__)
+
+# Значения по умолчанию для известных провайдеров: (base_url, модель)
+KNOWN_PROVIDERS = {
+    "openai": ("https://api.openai.com/v1", "gpt-4o-mini"),
+    "groq": ("https://api.groq.com/openai/v1", "llama-3.3-70b-versatile"),
+}
+
+
+class LatencyWindow:
+    """Скользящее окно последних замеров и перцентили по нему."""
+
+    def __init__(self, size: int = 200):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """closed → (failures подряд) → open → (cooldown) → half_open → closed/open."""
+
+    def __init__(self, failures: int = 5, cooldown: float = 30.0):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+        # half_open: пропускаем ровно один пробный запрос
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self._consecutive = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._consecutive += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self._consecutive >= self.failures:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Запрос отменён без результата — пробный слот освобождается."""
+        self._probe_in_flight = False
+
+
+class Provider:
+    def __init__(self, name: str, client: LLMClient, model: str, breaker: CircuitBreaker):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.breaker = breaker
+        self.latency = LatencyWindow()
+        self.first_token = LatencyWindow()
+
+    def payload(self, payload: dict) -> dict:
+        return {**payload, "model": self.model}
+
+    def record(self, ok: bool) -> None:
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        LLM_PROVIDER_STATE.set(
+            {"closed": 0, "half_open": 1, "open": 2}[self.breaker.state], provider=self.name
+        )
+
+
+def _is_provider_failure(error: LLMError) -> bool:
+    """Сбой провайдера, а не нашего запроса: сеть, таймаут, 429/5xx."""
+    return error.status is None or error.status in RETRY_STATUSES
+
+
+class LLMRouter:
+    def __init__(
+        self,
+        providers: list[Provider],
+        hedge: bool = True,
+        hedge_percentile: float = 0.9,
+        hedge_default_delay: float = 3.0,
+        hedge_min_samples: int = 20,
+    ):
+        if not providers:
+            raise ValueError("Нужен хотя бы один LLM-провайдер")
+        self.providers = providers
+        self.hedge = hedge and len(providers) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+
+    @classmethod
+    def from_env(cls, openai_api_key: str | None = None) -> "LLMRouter":
+        """
+        LLM_PROVIDERS=openai,groq — порядок = приоритет. Провайдеры без ключа пропускаются.
+        """
+        failures = _env_int("LLM_BREAKER_FAILURES", 5)
+        cooldown = _env_float("LLM_BREAKER_COOLDOWN", 30.0)
+        providers = []
+        for name in os.getenv("LLM_PROVIDERS", "openai").split(","):
+            name = name.strip().lower()
+            if not name:
+                continue
+            prefix = name.upper()
+            api_key = os.getenv(f"{prefix}_API_KEY") or (openai_api_key if name == "openai" else None)
+            if not api_key:
+                logger.warning("LLM-провайдер %s пропущен: нет %s_API_KEY", name, prefix)
+                continue
+            base_url, model = KNOWN_PROVIDERS.get(name, ("", ""))
+            client = LLMClient.from_env(api_key, prefix=prefix, default_base_url=base_url)
+            if not client.base_url:
+                logger.warning("LLM-провайдер %s пропущен: нет %s_BASE_URL", name, prefix)
+                continue
+            providers.append(Provider(
+                name, client, os.getenv(f"{prefix}_MODEL", model) or model,
+                CircuitBreaker(failures, cooldown),
+            ))
+
+        if not providers:
+            # Без ключей бот всё равно стартует — ask_openai ответит, что API не настроен
+            base_url, model = KNOWN_PROVIDERS["openai"]
+            client = LLMClient.from_env(openai_api_key or "", default_base_url=base_url)
+            providers.append(Provider("openai", client, model, CircuitBreaker(failures, cooldown)))
+
+        return cls(
+            providers,
+            hedge=os.getenv("LLM_HEDGE", "1") == "1",
+            hedge_percentile=_env_float("LLM_HEDGE_PERCENTILE", 0.9),
+            hedge_default_delay=_env_float("LLM_HEDGE_DEFAULT_DELAY", 3.0),
+        )
+
+    # ---------------------------
+    # Жизненный цикл
+    # ---------------------------
+
+    async def start(self) -> None:
+        for provider in self.providers:
+            await provider.client.start()
+        logger.info(
+            "LLM-провайдеры: %s, хеджирование: %s",
+            ", ".join(f"{p.name} ({p.model})" for p in self.providers),
+            "вкл" if self.hedge else "выкл",
+        )
+
+    async def close(self) -> None:
+        logger.info("LLM-провайдеры: %s", self.stats())
+        for provider in self.providers:
+            await provider.client.close()
+
+    def stats(self) -> dict:
+        def ms(value: float | None) -> int | None:
+            return None if value is None else round(value * 1000)
+
+        return {
+            p.name: {
+                "state": p.breaker.state,
+                "p50_ms": ms(p.latency.percentile(0.5)),
+                "p90_ms": ms(p.latency.percentile(0.9)),
+                "p99_ms": ms(p.latency.percentile(0.99)),
+                "first_token_p90_ms": ms(p.first_token.percentile(0.9)),
+            }
+            for p in self.providers
+        }
+
+    # ---------------------------
+    # Выбор провайдеров
+    # ---------------------------
+
+    @staticmethod
+    def _take(candidates: list[Provider]) -> Provider | None:
+        """Следующий по приоритету провайдер, чей выключатель пропускает запрос."""
+        while candidates:
+            provider = candidates.pop(0)
+            if provider.breaker.allow():
+                return provider
+        return None
+
+    def _hedge_delay(self, window: LatencyWindow) -> float:
+        if len(window) < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return window.percentile(self.hedge_percentile)
+
+    # ---------------------------
+    # Запросы
+    # ---------------------------
+
+    async def _call(self, provider: Provider, payload: dict) -> dict:
+        started = time.perf_counter()
+        try:
+            data = await provider.client.create_response(provider.payload(payload))
+        except LLMError as e:
+            if _is_provider_failure(e):
+                provider.record(ok=False)
+            else:
+                provider.breaker.release()
+            LLM_PROVIDER_REQUESTS.inc(provider=provider.name, result="error")
+            raise
+        except asyncio.CancelledError:
+            provider.breaker.release()
+            LLM_PROVIDER_REQUESTS.inc(provider=provider.name, result="cancelled")
+            raise
+        provider.latency.add(time.perf_counter() - started)
+        provider.record(ok=True)
+        LLM_PROVIDER_REQUESTS.inc(provider=provider.name, result="ok")
+        return data
+
+    async def create_response(self, payload: dict) -> dict:
+        """Ответ первого успевшего провайдера; LLMError — если не ответил ни один."""
+        candidates = list(self.providers)
+        pending: dict[asyncio.Task, Provider] = {}
+        last_error: LLMError | None = None
+
+        def launch(provider: Provider | None) -> None:
+            if provider is not None:
+                pending[asyncio.create_task(self._call(provider, payload))] = provider
+
+        # Если выключены все — пробуем основной: лучше попытка, чем гарантированная ошибка
+        launch(self._take(candidates) or self.providers[0])
+        try:
+            while pending:
+                # Следующий провайдер подключается, если текущие не успели за p90
+                timeout = None
+                if candidates and self.hedge:
+                    timeout = self._hedge_delay(pending[next(iter(pending))].latency)
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    LLM_HEDGES.inc(reason="slow")
+                    launch(self._take(candidates))
+                    continue
+
+                for task in done:
+                    pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                # Отказ без ответа — сразу пробуем следующего провайдера
+                if not pending and candidates:
+                    LLM_HEDGES.inc(reason="error")
+                    launch(self._take(candidates))
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise last_error
+
+    async def _pump(self, provider: Provider, payload: dict, queue: asyncio.Queue) -> None:
+        """
+        Читать стрим провайдера в очередь. Первым элементом — список событий до первого
+        куска текста включительно (response.created и т.п. приходят сразу после приёма
+        запроса и о скорости генерации ничего не говорят), дальше — по событию,
+        затем None (конец) или исключение.
+        """
+        started = time.perf_counter()
+        prefix: list[dict] | None = []
+        stream = provider.client.stream_response(provider.payload(payload))
+        try:
+            async for event in stream:
+                if prefix is None:
+                    await queue.put(event)
+                    continue
+                prefix.append(event)
+                if event.get("type") == "response.output_text.delta":
+                    provider.first_token.add(time.perf_counter() - started)
+                    await queue.put(prefix)
+                    prefix = None
+            if prefix is not None:
+                # Ответ без текста (пустой или response.failed) — отдаём как есть
+                await queue.put(prefix)
+        except LLMError as e:
+            if _is_provider_failure(e):
+                provider.record(ok=False)
+            else:
+                provider.breaker.release()
+            LLM_PROVIDER_REQUESTS.inc(provider=provider.name, result="error")
+            await queue.put(e)
+            return
+        except asyncio.CancelledError:
+            provider.breaker.release()
+            LLM_PROVIDER_REQUESTS.inc(provider=provider.name, result="cancelled")
+            raise
+        except Exception as e:
+            # Любой другой сбой тоже должен дойти до читателя, иначе он ждёт вечно
+            logger.exception("Стрим провайдера %s упал", provider.name)
+            provider.record(ok=False)
+            LLM_PROVIDER_REQUESTS.inc(provider=provider.name, result="error")
+            await queue.put(LLMError(f"{type(e).__name__}: {e}"))
+            return
+        finally:
+            # Отменённый стрим закрываем сразу, чтобы соединение вернулось в пул
+            await stream.aclose()
+        provider.latency.add(time.perf_counter() - started)
+        provider.record(ok=True)
+        LLM_PROVIDER_REQUESTS.inc(provider=provider.name, result="ok")
+        await queue.put(None)
+
+    @staticmethod
+    async def _next(queue: asyncio.Queue, pump: asyncio.Task):
+        """Следующий элемент очереди; если _pump завершился, ничего не положив, — LLMError."""
+        getter = asyncio.ensure_future(queue.get())
+        try:
+            await asyncio.wait({getter, pump}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not getter.done():
+                getter.cancel()
+        if getter.done() and not getter.cancelled():
+            return getter.result()
+        if not queue.empty():
+            return queue.get_nowait()
+        error = None if pump.cancelled() else pump.exception()
+        return LLMError(f"Стрим провайдера прервался без ответа: {error!r}")
+
+    async def stream_response(self, payload: dict) -> AsyncIterator[dict]:
+        """
+        Стрим от провайдера, первым приславшего текст. Хеджирование — только до
+        первого куска текста: дальше он уже идёт пользователю, и переключаться нельзя.
+        События до него придерживаются в _pump и отдаются победителем целиком.
+        """
+        candidates = list(self.providers)
+        streams: dict[asyncio.Queue, tuple[asyncio.Task, Provider]] = {}
+        waiters: dict[asyncio.Task, asyncio.Queue] = {}
+        last_error: LLMError | None = None
+
+        def launch(provider: Provider | None) -> None:
+            if provider is None:
+                return
+            queue: asyncio.Queue = asyncio.Queue()
+            pump = asyncio.create_task(self._pump(provider, payload, queue))
+            streams[queue] = (pump, provider)
+            waiters[asyncio.create_task(self._next(queue, pump))] = queue
+
+        winner: asyncio.Queue | None = None
+        first_item = None
+        launch(self._take(candidates) or self.providers[0])
+        try:
+            while winner is None and waiters:
+                timeout = None
+                if candidates and self.hedge:
+                    _, provider = streams[next(iter(waiters.values()))]
+                    timeout = self._hedge_delay(provider.first_token)
+                done, _ = await asyncio.wait(
+                    waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    LLM_HEDGES.inc(reason="slow")
+                    launch(self._take(candidates))
+                    continue
+
+                for waiter in done:
+                    queue = waiters.pop(waiter)
+                    item = waiter.result()
+                    if isinstance(item, LLMError):
+                        last_error = item
+                        continue
+                    if winner is None:
+                        winner, first_item = queue, item
+                if winner is None and not waiters and candidates:
+                    LLM_HEDGES.inc(reason="error")
+                    launch(self._take(candidates))
+
+            # Проигравшие стримы больше не нужны
+            for waiter in waiters:
+                waiter.cancel()
+            for queue, (task, _) in streams.items():
+                if queue is not winner:
+                    task.cancel()
+
+            if winner is None:
+                raise last_error or LLMError("Ни один LLM-провайдер не ответил")
+
+            for event in first_item:
+                yield event
+            pump, _ = streams[winner]
+            while (item := await self._next(winner, pump)) is not None:
+                if isinstance(item, LLMError):
+                    raise item
+                yield item
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+            for task, _ in streams.values():
+                task.cancel()
@@ -0,0 +1,136 @@
+"""
+Память диалога с бюджетом по токенам.
+
+Состояние хранится прямо в context.user_data["memory"] обычным словарем
+(его сохраняет persistence):
+
+    {"summary": "краткое содержание старой части диалога",
+     "turns": [{"role": "user", "content": "..."}, {"role": "assistant", ...}]}
+
+В запрос уходит: сводка (если есть) + последние MEMORY_KEEP_TURNS пар реплик
+дословно + новое сообщение. Всё, что старше или не влезает в бюджет,
+сворачивается в сводку отдельным коротким запросом к модели.
+"""
+
+import logging
+import os
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1500"))
+MEMORY_KEEP_TURNS = int(os.getenv("MEMORY_KEEP_TURNS", "4"))
+# Сводка тоже не должна расти бесконечно
+MEMORY_SUMMARY_MAX_CHARS = 1200
+
+Summarizer = Callable[[str, list[dict]], Awaitable[str]]
+
+# Память, которую сейчас сворачивают (id словаря состояния). Свёртку может запустить
+# и шаблонный ответ в обработчике, и ответ модели в фоне (coalescer) — вторая,
+# начавшись поверх первой, удалила бы несвёрнутые реплики и затёрла сводку.
+# Не в самом состоянии: флаг не должен попасть в persistence и пережить падение.
+_compacting: set[int] = set()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора.
+    Для русского текста у моделей OpenAI выходит примерно 3 символа на токен.
+    """
+    return len(text) // 3 + 1
+
+
+class ConversationMemory:
+    """Обёртка над словарем памяти одного пользователя."""
+
+    def __init__(
+        self,
+        state: dict,
+        token_budget: int = MEMORY_TOKEN_BUDGET,
+        keep_turns: int = MEMORY_KEEP_TURNS,
+    ):
+        self.state = state
+        self.state.setdefault("summary", "")
+        self.state.setdefault("turns", [])
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+
+    @classmethod
+    def for_user(cls, user_data: dict) -> "ConversationMemory":
+        return cls(user_data.setdefault("memory", {}))
+
+    @property
+    def summary(self) -> str:
+        return self.state["summary"]
+
+    @property
+    def turns(self) -> list[dict]:
+        return self.state["turns"]
+
+    def history_tokens(self) -> int:
+        return estimate_tokens(self.summary) + sum(
+            estimate_tokens(t["content"]) for t in self.turns
+        )
+
+    def build_input(self, prompt: str, facts: str = "") -> list[dict]:
+        """Сообщения для поля input Responses API (без системного промпта)."""
+        messages = []
+
+        context_parts = []
+        if self.summary:
+            context_parts.append(f"Краткое содержание предыдущего диалога: {self.summary}")
+        if facts:
+            context_parts.append(f"Уже известно о клиенте: {facts}")
+        if context_parts:
+            messages.append({"role": "developer", "content": "\n".join(context_parts)})
+
+        messages.extend(self.turns)
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def add_turn(self, user_text: str, assistant_text: str) -> None:
+        self.turns.append({"role": "user", "content": user_text})
+        self.turns.append({"role": "assistant", "content": assistant_text})
+
+    def _overflow(self) -> int:
+        """Сколько самых старых сообщений нужно свернуть в сводку."""
+        keep = self.keep_turns * 2
+        count = max(0, len(self.turns) - keep)
+
+        # Если и оставшиеся не влезают в бюджет — сворачиваем ещё по паре
+        tokens = self.history_tokens() - sum(
+            estimate_tokens(t["content"]) for t in self.turns[:count]
+        )
+        while tokens > self.token_budget and count < len(self.turns) - 2:
+            tokens -= estimate_tokens(self.turns[count]["content"])
+            tokens -= estimate_tokens(self.turns[count + 1]["content"])
+            count += 2
+        return count
+
+    async def compact(self, summarizer: Summarizer) -> None:
+        """
+        Свернуть старые реплики в сводку, если история вышла за лимиты.
+        Если свёртка уже идёт — выходим: остаток свернёт следующий вызов.
+        """
+        key = id(self.state)
+        if key in _compacting:
+            return
+        count = self._overflow()
+        if not count:
+            return
+
+        _compacting.add(key)
+        try:
+            old = self.turns[:count]
+            try:
+                summary = await summarizer(self.summary, old)
+            except Exception as e:
+                # Модель недоступна — просто отбрасываем старое, бюджет важнее
+                logger.warning("Не удалось обновить сводку диалога: %s", e)
+                summary = self.summary
+
+            self.state["summary"] = summary.strip()[:MEMORY_SUMMARY_MAX_CHARS]
+            # Пока ждали сводку, реплики могли только добавиться в конец
+            del self.turns[:count]
+        finally:
+            _compacting.discard(key)
@@ -0,0 +1,379 @@
+"""
+Метрики горячего пути и трассировка апдейтов.
+
+— Счётчики, гистограммы и gauge с метками, без внешних зависимостей.
+— /metrics в текстовом формате Prometheus на METRICS_PORT (0 — выключено).
+— Gauge лага event loop: насколько позже запланированного просыпается цикл.
+— trace_id апдейта в contextvar; при TRACE_LOGS=1 логи пишутся JSON-строками
+  с trace_id, чтобы собрать всю историю одного сообщения.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+from aiohttp import web
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# По умолчанию только локально; 0.0.0.0 — если Prometheus ходит с другой машины
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+TRACE_LOGS = os.getenv("TRACE_LOGS", "0") == "1"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# ===========================
+# ПРИМИТИВЫ
+# ===========================
+
+def _label_key(labelnames: tuple[str, ...], labels: dict) -> tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: tuple[str, ...], key: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def _header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.labelnames, labels), 0.0)
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[_label_key(self.labelnames, labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # ключ меток → [счётчики по корзинам..., +Inf], сумма
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list[str]:
+        lines = self._header()
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labelnames, key, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {self._sums[key]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ===========================
+# МЕТРИКИ БОТА
+# ===========================
+
+LLM_LATENCY = Histogram(
+    "domovoy_llm_request_seconds", "Длительность запроса к LLM (до полного ответа)", ("mode",)
+)
+LLM_FIRST_TOKEN = Histogram(
+    "domovoy_llm_first_token_seconds", "Время до первого куска текста потокового ответа"
+)
+LLM_REQUESTS = Counter(
+    "domovoy_llm_requests_total", "Запросы к LLM по итоговому статусу", ("mode", "status")
+)
+LLM_TOKENS = Counter(
+    "domovoy_llm_tokens_total", "Токены по данным usage Responses API", ("kind",)
+)
+LLM_PROVIDER_REQUESTS = Counter(
+    "domovoy_llm_provider_requests_total", "Запросы к провайдерам LLM по результату", ("provider", "result")
+)
+LLM_PROVIDER_STATE = Gauge(
+    "domovoy_llm_provider_breaker_state", "Выключатель провайдера: 0 — закрыт, 1 — пробный, 2 — открыт",
+    ("provider",),
+)
+LLM_HEDGES = Counter(
+    "domovoy_llm_hedges_total", "Запросы, продублированные другому провайдеру", ("reason",)
+)
+ADMISSION_DECISIONS = Counter(
+    "domovoy_llm_admission_total",
+    "Решения о допуске запроса к LLM: ok или причина отказа (user / global / busy)", ("priority", "result"),
+)
+LLM_BUDGET_TOKENS = Gauge(
+    "domovoy_llm_budget_tokens", "Остаток в ведре токенов LLM (может уйти в минус)", ("scope",)
+)
+COALESCED_MESSAGES = Counter(
+    "domovoy_coalesced_messages_total", "Сообщения, ушедшие в LLM пачкой из нескольких (см. coalescer)"
+)
+SUPERSEDED_GENERATIONS = Counter(
+    "domovoy_superseded_generations_total", "Генерации, отменённые новым сообщением до показа ответа"
+)
+COMMENTARY_DELIVERY = Histogram(
+    "domovoy_commentary_delivery_seconds",
+    "От расчёта до отправки инженерного комментария (или отказа от него)", ("result",),
+)
+LEAD_SAVE = Histogram("domovoy_lead_save_seconds", "Сохранение лида (ожидание записи на диск)")
+ADMIN_NOTIFY = Histogram(
+    "domovoy_admin_notify_seconds", "Отправка уведомления администратору", ("result",)
+)
+ADMIN_OUTBOX_DUE = Gauge(
+    "domovoy_admin_outbox_due", "Уведомлений, готовых к отправке, при последнем разборе очереди"
+)
+TELEGRAM_REQUEST = Histogram(
+    "domovoy_telegram_request_seconds", "Запросы к Bot API", ("method",)
+)
+UPDATE_LATENCY = Histogram(
+    "domovoy_update_seconds", "Обработка апдейта (включая ожидание очереди чата)", ("phase",)
+)
+STAGE_TRANSITIONS = Counter(
+    "domovoy_stage_transitions_total", "Переходы между этапами воронки", ("from_stage", "to_stage")
+)
+FUNNEL_ENTERED = Counter(
+    "domovoy_funnel_stage_entered_total", "Сколько раз пользователи доходили до этапа", ("stage",)
+)
+FUNNEL_ABANDONED = Counter(
+    "domovoy_funnel_abandoned_total", "Воронку начали заново (/start) на этом этапе", ("stage",)
+)
+SESSIONS_IN_MEMORY = Gauge("domovoy_sessions_in_memory", "Сессии пользователей, загруженные в память")
+SESSION_BYTES = Gauge(
+    "domovoy_session_bytes", "Средний размер сессии в памяти по выборке (с лидом и памятью диалога)"
+)
+SESSIONS_EVICTED = Counter(
+    "domovoy_sessions_evicted_total", "Простаивающие сессии, выгруженные из памяти на диск"
+)
+SESSIONS_LOADED = Counter(
+    "domovoy_sessions_loaded_total", "Сессии, загруженные с диска (после вытеснения или перезапуска)"
+)
+PROCESS_RSS = Gauge("domovoy_process_resident_bytes", "Resident set процесса")
+LOOP_LAG = Gauge("domovoy_event_loop_lag_seconds", "Текущий лаг event loop")
+LOOP_LAG_MAX = Gauge(
+    "domovoy_event_loop_lag_max_seconds", "Максимальный лаг event loop за последний интервал"
+)
+
+
+def record_stage(old: str, new: str) -> None:
+    if old == new:
+        return
+    STAGE_TRANSITIONS.inc(from_stage=old, to_stage=new)
+    FUNNEL_ENTERED.inc(stage=new)
+
+
+def record_usage(usage: dict | None) -> None:
+    if not usage:
+        return
+    cached = (usage.get("input_tokens_details") or {}).get("cached_tokens", 0)
+    LLM_TOKENS.inc(usage.get("input_tokens") or 0, kind="input")
+    LLM_TOKENS.inc(cached or 0, kind="cached")
+    LLM_TOKENS.inc(usage.get("output_tokens") or 0, kind="output")
+
+
+# ===========================
+# ТРАССИРОВКА
+# ===========================
+
+trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+
+
+def new_trace_id(update_id: int | None = None) -> str:
+    trace_id = f"u{update_id}-{uuid.uuid4().hex[:8]}" if update_id else uuid.uuid4().hex[:12]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+class _TraceFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        return True
+
+
+class _JsonFormatter(logging.Formatter):
+    def __init__(self, worker: int | None = None):
+        super().__init__()
+        self.worker = worker
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if self.worker is not None:
+            entry["worker"] = self.worker
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level: int = logging.INFO, worker: int | None = None) -> None:
+    """Обычные логи или (TRACE_LOGS=1) JSON-строки с trace_id апдейта."""
+    handler = logging.StreamHandler()
+    handler.addFilter(_TraceFilter())
+    if TRACE_LOGS:
+        handler.setFormatter(_JsonFormatter(worker))
+    else:
+        prefix = f"[w{worker}] " if worker is not None else ""
+        handler.setFormatter(logging.Formatter(prefix + "%(levelname)s:%(name)s:%(message)s"))
+    logging.basicConfig(level=level, handlers=[handler])
+
+
+# ===========================
+# ЗАПРОСЫ К BOT API
+# ===========================
+
+class TimedRequest(BaseRequest):
+    """Обёртка над транспортом Bot API: время каждого запроса по методу (sendMessage, …)."""
+
+    def __init__(self, inner: BaseRequest):
+        self._inner = inner
+
+    @property
+    def read_timeout(self) -> float | None:
+        return self._inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self._inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self._inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts) -> tuple[int, bytes]:
+        with TELEGRAM_REQUEST.time(method=url.rsplit("/", 1)[-1]):
+            return await self._inner.do_request(url, method, request_data, **timeouts)
+
+
+# ===========================
+# ЛАГ EVENT LOOP И HTTP-ЭНДПОИНТ
+# ===========================
+
+async def _watch_loop_lag(interval: float = 0.1, window: float = 10.0) -> None:
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    window_started = loop.time()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        LOOP_LAG.set(lag)
+        worst = max(worst, lag)
+        if loop.time() - window_started >= window:
+            LOOP_LAG_MAX.set(worst)
+            worst = 0.0
+            window_started = loop.time()
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер /metrics и фоновая задача замера лага."""
+
+    def __init__(self, port: int = METRICS_PORT, host: str = METRICS_HOST):
+        self.port = port
+        self.host = host
+        self._runner: web.AppRunner | None = None
+        self._lag_task: asyncio.Task | None = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def start(self) -> None:
+        self._lag_task = asyncio.create_task(_watch_loop_lag())
+        if not self.port:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Метрики доступны на %s:%s/metrics", self.host, self.port)
+
+    async def close(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            try:
+                await self._lag_task
+            except asyncio.CancelledError:
+                pass
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
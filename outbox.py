@@ -0,0 +1,222 @@
+"""
+Исходящая очередь (outbox) уведомлений администратору о новых лидах.
+
+handle_message только кладёт уведомление в SQLite-очередь и сразу отвечает
+пользователю. Фоновая задача разбирает очередь:
+— не чаще одного сообщения в OUTBOX_MIN_INTERVAL секунд на чат (лимиты Telegram
+  для каналов и групп), при RetryAfter ждёт столько, сколько просит Telegram;
+— если за это время накопилось несколько заявок, отправляет их одним дайджестом;
+— при ошибках повторяет с нарастающей паузой, пока не доставит. Очередь на диске,
+  поэтому недоставленное переживает перезапуск.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+
+from metrics import ADMIN_NOTIFY, ADMIN_OUTBOX_DUE
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+DIGEST_SEPARATOR = "\n\n———\n\n"
+
+
+class AdminOutbox:
+    def __init__(
+        self,
+        path: str = "outbox.db",
+        min_interval: float = 3.0,
+        max_digest: int = 10,
+        poll_interval: float = 1.0,
+        max_backoff: float = 300.0,
+    ):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_digest = max_digest
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+
+        self._bot: Bot | None = None
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._drainer: asyncio.Task | None = None
+        self._next_send_at: dict[int, float] = {}
+
+    @classmethod
+    def from_env(cls) -> "AdminOutbox":
+        return cls(
+            path=os.getenv("OUTBOX_PATH", "outbox.db"),
+            min_interval=float(os.getenv("OUTBOX_MIN_INTERVAL", "3")),
+            max_digest=int(os.getenv("OUTBOX_MAX_DIGEST", "10")),
+        )
+
+    # ---------------------------
+    # Жизненный цикл
+    # ---------------------------
+
+    async def start(self, bot: Bot | None = None) -> None:
+        """Открыть очередь. С bot — ещё и запустить доставку (в webhook-режиме только в одном воркере)."""
+        await asyncio.to_thread(self._open)
+        if bot is not None:
+            self._bot = bot
+            self._drainer = asyncio.create_task(self._drain_loop(), name="admin_outbox")
+            self._wakeup.set()
+
+    async def close(self) -> None:
+        if self._drainer is not None:
+            self._drainer.cancel()
+            try:
+                await self._drainer
+            except asyncio.CancelledError:
+                pass
+            self._drainer = None
+        await asyncio.to_thread(self._close)
+
+    # ---------------------------
+    # SQLite (вызывается в потоке)
+    # ---------------------------
+
+    def _open(self) -> None:
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " chat_id INTEGER NOT NULL,"
+                " text TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def _close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _insert(self, chat_id: int, text: str) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO outbox (chat_id, text, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                (chat_id, text, now, now),
+            )
+
+    def _due(self) -> dict[int, list[tuple[int, str, int]]]:
+        """Готовые к отправке уведомления по чатам: [(id, text, attempts), ...]."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, chat_id, text, attempts FROM outbox "
+                "WHERE next_attempt_at <= ? ORDER BY id",
+                (time.time(),),
+            ).fetchall()
+        by_chat: dict[int, list[tuple[int, str, int]]] = {}
+        for row_id, chat_id, text, attempts in rows:
+            by_chat.setdefault(chat_id, []).append((row_id, text, attempts))
+        return by_chat
+
+    def _delete(self, ids: list[int]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+    def _postpone(self, ids: list[int], delay: float) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                [(time.time() + delay, i) for i in ids],
+            )
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    # ---------------------------
+    # API
+    # ---------------------------
+
+    async def enqueue(self, chat_id: int, text: str) -> None:
+        """Поставить уведомление в очередь (запись на диск, без сетевых запросов)."""
+        await asyncio.to_thread(self._insert, int(chat_id), text)
+        self._wakeup.set()
+
+    # ---------------------------
+    # Доставка
+    # ---------------------------
+
+    def _digest(self, items: list[tuple[int, str, int]]) -> tuple[list[int], str]:
+        """Склеить несколько уведомлений в одно сообщение в пределах лимита Telegram."""
+        ids = [items[0][0]]
+        texts = [items[0][1]]
+        length = len(items[0][1])
+        for row_id, text, _ in items[1:self.max_digest]:
+            length += len(DIGEST_SEPARATOR) + len(text)
+            if length > TELEGRAM_MESSAGE_LIMIT - 100:
+                break
+            ids.append(row_id)
+            texts.append(text)
+
+        if len(texts) == 1:
+            return ids, texts[0][:TELEGRAM_MESSAGE_LIMIT]
+        header = f"📦 Заявок за последние минуты: {len(texts)}\n\n"
+        return ids, header + DIGEST_SEPARATOR.join(texts)
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.max_backoff, 2.0 * (2 ** attempts))
+
+    async def _send(self, chat_id: int, items: list[tuple[int, str, int]]) -> None:
+        ids, text = self._digest(items)
+        started = time.perf_counter()
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            ADMIN_NOTIFY.observe(time.perf_counter() - started, result="retry_after")
+            delay = float(e.retry_after)
+            logger.warning("Flood-лимит для чата %s, ждём %.0f с", chat_id, delay)
+            self._next_send_at[chat_id] = time.monotonic() + delay
+            return
+        except TelegramError as e:
+            ADMIN_NOTIFY.observe(time.perf_counter() - started, result="error")
+            attempts = max(a for _, _, a in items[:len(ids)])
+            delay = self._backoff(attempts)
+            logger.error(
+                "Не удалось отправить %s уведомл. в %s: %s (повтор через %.0f с)",
+                len(ids), chat_id, e, delay,
+            )
+            await asyncio.to_thread(self._postpone, ids, delay)
+            return
+
+        ADMIN_NOTIFY.observe(time.perf_counter() - started, result="ok")
+        await asyncio.to_thread(self._delete, ids)
+        self._next_send_at[chat_id] = time.monotonic() + self.min_interval
+        logger.info("Админу отправлено уведомлений: %s", len(ids))
+
+    async def _drain_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                due = await asyncio.to_thread(self._due)
+                ADMIN_OUTBOX_DUE.set(sum(len(items) for items in due.values()))
+                now = time.monotonic()
+                for chat_id, items in due.items():
+                    if self._next_send_at.get(chat_id, 0) <= now:
+                        await self._send(chat_id, items)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка при разборе очереди уведомлений: %s", e)
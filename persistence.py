@@ -0,0 +1,285 @@
+"""
+Персистентность состояния воронки (context.user_data) между перезапусками.
+
+— При старте ничего не загружается: get_user_data() возвращает пустой словарь,
+  поэтому запуск не зависит от числа пользователей.
+— Данные пользователя подтягиваются лениво в refresh_user_data(), который
+  Application вызывает перед первым обработчиком для этого пользователя.
+— Application сам отмечает пользователей, чьи апдейты обрабатывались, и раз
+  в update_interval вызывает update_user_data() только для них. Мы дополнительно
+  пропускаем записи, которые не изменились, и пишем остальное одной транзакцией.
+— user_data — это session.Session; простаивающие сессии SessionEvictor выгружает
+  сюда же через spill() и убирает из памяти, а refresh_user_data() вернёт их при
+  следующем сообщении.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from metrics import SESSIONS_LOADED
+from session import Session
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteUserDataPersistence(BasePersistence):
+    """Хранит только user_data: одна строка SQLite (WAL) на пользователя."""
+
+    def __init__(self, path: str = "state.db", update_interval: float = 5.0):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+        self._loaded: set[int] = set()
+        self._written: dict[int, int] = {}  # хэш последней записи — не пишем без изменений
+        self._pending: dict[int, str | None] = {}  # None — удалить запись
+        # Выгруженные из памяти: их drop_user_data — не удаление (см. forget)
+        self._evicted: set[int] = set()
+        self._flush_task: asyncio.Task | None = None
+
+    @classmethod
+    def from_env(cls) -> "SqliteUserDataPersistence":
+        return cls(
+            path=os.getenv("STATE_DB_PATH", "state.db"),
+            update_interval=float(os.getenv("STATE_FLUSH_INTERVAL", "5")),
+        )
+
+    # ---------------------------
+    # SQLite (вызывается в потоке)
+    # ---------------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_data ("
+                " user_id INTEGER PRIMARY KEY,"
+                " data TEXT NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _load_row(self, user_id: int) -> str | None:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data FROM user_data WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _write_rows(self, rows: dict[int, str | None]) -> None:
+        upserts = [(uid, data) for uid, data in rows.items() if data is not None]
+        deletes = [(uid,) for uid, data in rows.items() if data is None]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                if upserts:
+                    conn.executemany(
+                        "INSERT INTO user_data (user_id, data) VALUES (?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                        upserts,
+                    )
+                if deletes:
+                    conn.executemany("DELETE FROM user_data WHERE user_id = ?", deletes)
+
+    # ---------------------------
+    # Запись изменений
+    # ---------------------------
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self) -> None:
+        # Даём остальным update_user_data из того же прохода попасть в пачку
+        await asyncio.sleep(0)
+        if not self._pending:
+            return
+
+        rows, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write_rows, rows)
+        except Exception as e:
+            logger.error("Не удалось сохранить состояние %s пользователей: %s", len(rows), e)
+            # Вернём в очередь, если за это время не появилось более свежих данных
+            for uid, data in rows.items():
+                self._pending.setdefault(uid, data)
+            return
+
+        for uid, data in rows.items():
+            if data is None:
+                self._written.pop(uid, None)
+            else:
+                self._written[uid] = hash(data)
+
+    @staticmethod
+    def _encode(user_id: int, data: Session | dict) -> str | None:
+        try:
+            return json.dumps(dict(data), ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.error("Состояние пользователя %s не сериализуется в JSON: %s", user_id, e)
+            return None
+
+    async def update_user_data(self, user_id: int, data: Session | dict) -> None:
+        # Не загруженная с диска сессия — пустая заготовка после вытеснения
+        # (кто-то обратился к application.user_data[user_id] без апдейта) — не затираем ею запись
+        if user_id not in self._loaded:
+            return
+        encoded = self._encode(user_id, data)
+        if encoded is None:
+            return
+
+        if self._written.get(user_id) == hash(encoded) and user_id not in self._pending:
+            return
+        self._pending[user_id] = encoded
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicted:
+            # Application.drop_user_data после вытеснения: запись на диске нужна
+            self._evicted.discard(user_id)
+            return
+        self._pending[user_id] = None
+        self._loaded.discard(user_id)
+        self._schedule_flush()
+
+    # ---------------------------
+    # Вытеснение из памяти
+    # ---------------------------
+
+    async def spill(self, sessions: dict[int, Session]) -> list[int]:
+        """
+        Записать сессии на диск одной транзакцией, не дожидаясь update_interval.
+        Возвращает пользователей, чьё состояние на диске теперь актуально.
+        """
+        # Отложенная запись могла уже уйти в поток — пусть закончит, иначе перезапишет нас старым
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+
+        rows: dict[int, str] = {}
+        stored: list[int] = []
+        for user_id, session in sessions.items():
+            if user_id not in self._loaded:
+                # Пустая заготовка (см. update_user_data) — убрать из памяти, ничего не записывая
+                stored.append(user_id)
+                continue
+            encoded = self._encode(user_id, session)
+            if encoded is None:
+                continue
+            stored.append(user_id)
+            # Свежее отложенной записи, если она есть; без изменений — не пишем
+            self._pending.pop(user_id, None)
+            if self._written.get(user_id) != hash(encoded):
+                rows[user_id] = encoded
+
+        if rows:
+            try:
+                await asyncio.to_thread(self._write_rows, rows)
+            except Exception as e:
+                logger.error("Не удалось выгрузить %s сессий на диск: %s", len(rows), e)
+                for uid, data in rows.items():
+                    self._pending.setdefault(uid, data)
+                return [uid for uid in stored if uid not in rows]
+            for uid, data in rows.items():
+                self._written[uid] = hash(data)
+        return stored
+
+    def forget(self, user_id: int) -> None:
+        """
+        Сессия убрана из памяти (Application.drop_user_data): при следующем апдейте
+        refresh_user_data загрузит её с диска. Если пользователь вернётся раньше,
+        чем Application передаст нам drop_user_data, его изменения из этого окна
+        запишутся при следующем апдейте.
+        """
+        self._loaded.discard(user_id)
+        self._written.pop(user_id, None)
+        self._evicted.add(user_id)
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._pending:
+            rows, self._pending = self._pending, {}
+            await asyncio.to_thread(self._write_rows, rows)
+
+        def _close() -> None:
+            with self._lock:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+
+        await asyncio.to_thread(_close)
+
+    # ---------------------------
+    # Ленивое чтение
+    # ---------------------------
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Session | dict) -> None:
+        # Вызывается перед обработкой каждого апдейта пользователя — отмечаем активность
+        if isinstance(user_data, Session):
+            user_data.touch()
+        if user_id in self._loaded:
+            return
+
+        encoded = self._pending.get(user_id) or await asyncio.to_thread(self._load_row, user_id)
+        self._loaded.add(user_id)
+        if not encoded:
+            return
+
+        SESSIONS_LOADED.inc()
+        self._written.setdefault(user_id, hash(encoded))
+        for key, value in json.loads(encoded).items():
+            user_data.setdefault(key, value)
+
+    # ---------------------------
+    # Остальное не храним
+    # ---------------------------
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
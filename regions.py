@@ -0,0 +1,170 @@
+"""
+Справочник регионов: выработка 1 кВт СЭС по месяцам и тариф для населения
+(regions.json рядом с кодом) и нечёткий поиск региона по ответу клиента.
+
+Ответ на этапе waiting_for_region — свободный текст: «Подмосковье», «Краснодарский»,
+«под Тулой», «Сочи». Поиск идёт по нарастающей стоимости:
+1) точное совпадение всей строки, пары слов или слова с названием/синонимом;
+2) триграммы (как pg_trgm): для строки и каждого слова ищем запись с наибольшим
+   коэффициентом Дайса по общим триграммам через обратный индекс.
+Справочник и индекс загружаются при первом обращении, результаты поиска кэшируются.
+"""
+
+import json
+import os
+import re
+from dataclasses import dataclass
+from functools import cache, lru_cache
+
+REGIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.json")
+
+# Ниже этого сходства считаем, что регион не распознан
+MIN_SIMILARITY = 0.5
+# Слова короче не ищем нечётко: «мо», «ло» и т.п. — только точным совпадением
+MIN_FUZZY_LENGTH = 4
+
+# Служебные слова, которые не помогают отличить регион
+STOP_WORDS = frozenset(
+    "область обл край республика респ автономный автономная округ ао город г гор "
+    "район р-н пригород поселок пос село деревня в во под из около рядом с со на у "
+    "недалеко от возле живу живем дом дача".split()
+)
+
+_CLEAN_RE = re.compile(r"[^\w\s-]")
+
+
+@dataclass(frozen=True, slots=True)
+class Region:
+    name: str
+    # Ключ региона — нормализованное название (как estimator.normalize_region)
+    key: str
+    tariff: float
+    # кВт⋅ч с 1 кВт по месяцам, январь…декабрь
+    monthly_yield: tuple[int, ...]
+
+    @property
+    def avg_yield(self) -> float:
+        """Средняя выработка 1 кВт за месяц, кВт⋅ч."""
+        return sum(self.monthly_yield) / 12
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(_CLEAN_RE.sub(" ", text.lower().replace("ё", "е")).split())
+
+
+def _words(text: str) -> list[str]:
+    return [w for w in normalize_text(text).split() if w not in STOP_WORDS]
+
+
+def _trigrams(words: list[str]) -> set[str]:
+    grams = set()
+    for word in words:
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class RegionIndex:
+    def __init__(self, regions: list[Region], aliases: dict[str, list[str]]):
+        self.regions = regions
+        self.by_key = {r.key: r for r in regions}
+        self._exact: dict[str, Region] = {}
+        self._entries: list[tuple[Region, int]] = []
+        self._postings: dict[str, list[int]] = {}
+
+        stripped: dict[str, Region] = {}
+        for region in regions:
+            for name in [region.name, *aliases.get(region.name, [])]:
+                words = _words(name)
+                self._exact[normalize_text(name)] = region
+                # «Республика Алтай» без служебных слов — «алтай», но синоним «алтай»
+                # у Алтайского края важнее: такие формы не перекрывают явные названия
+                stripped.setdefault(" ".join(words), region)
+
+                grams = _trigrams(words)
+                entry_id = len(self._entries)
+                self._entries.append((region, len(grams)))
+                for gram in grams:
+                    self._postings.setdefault(gram, []).append(entry_id)
+        for text, region in stripped.items():
+            self._exact.setdefault(text, region)
+
+    @classmethod
+    def load(cls, path: str = REGIONS_PATH) -> "RegionIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        regions = []
+        aliases = {}
+        for item in data["regions"]:
+            regions.append(Region(
+                name=item["name"],
+                key=normalize_text(item["name"]),
+                tariff=float(item["tariff"]),
+                monthly_yield=tuple(item["yield"]),
+            ))
+            aliases[item["name"]] = item.get("aliases", [])
+        return cls(regions, aliases)
+
+    def _fuzzy(self, words: list[str]) -> tuple[float, Region | None]:
+        grams = _trigrams(words)
+        if not grams:
+            return 0.0, None
+        shared: dict[int, int] = {}
+        for gram in grams:
+            for entry_id in self._postings.get(gram, ()):
+                shared[entry_id] = shared.get(entry_id, 0) + 1
+
+        best_score, best = 0.0, None
+        for entry_id, common in shared.items():
+            region, size = self._entries[entry_id]
+            score = 2 * common / (len(grams) + size)
+            if score > best_score:
+                best_score, best = score, region
+        return best_score, best
+
+    def lookup(self, text: str) -> Region | None:
+        # 1) точные совпадения: строка как есть (до выброса служебных слов, иначе
+        #    «Республика Алтай» превратится в «алтай» — синоним Алтайского края),
+        #    вся строка без служебных слов, пары слов, отдельные слова
+        region = self._exact.get(normalize_text(text))
+        if region is not None:
+            return region
+        words = _words(text)
+        if not words:
+            return None
+
+        candidates = [" ".join(words)]
+        candidates += [f"{a} {b}" for a, b in zip(words, words[1:])]
+        candidates += words
+        for candidate in candidates:
+            region = self._exact.get(candidate)
+            if region is not None:
+                return region
+
+        # 2) триграммы: для всей строки и для каждого достаточно длинного слова
+        #    (порог длины и для строки: «юг» похоже на «югра» наполовину)
+        best_score, best = 0.0, None
+        if len("".join(words)) >= MIN_FUZZY_LENGTH:
+            best_score, best = self._fuzzy(words)
+        for word in words:
+            if len(word) >= MIN_FUZZY_LENGTH:
+                score, region = self._fuzzy([word])
+                if score > best_score:
+                    best_score, best = score, region
+        return best if best_score >= MIN_SIMILARITY else None
+
+
+@cache
+def region_index() -> RegionIndex:
+    """Справочник загружается один раз, при первом обращении."""
+    return RegionIndex.load()
+
+
+@lru_cache(maxsize=4096)
+def lookup_region(text: str) -> Region | None:
+    """Регион по свободному тексту («Подмосковье», «под Краснодаром», «Сочи») или None."""
+    return region_index().lookup(text)
+
+
+def region_by_key(key: str) -> Region | None:
+    return region_index().by_key.get(key)
@@ -0,0 +1,168 @@
+"""
+Офлайн-переоценка базы лидов с новыми параметрами расчёта.
+
+Лиды читаются потоком из хранилища (LEAD_STORE / LEAD_STORE_PATH, как у бота)
+порциями по --chunk, каждая порция считается одним вызовом estimate_batch —
+старыми (по умолчанию) и новыми параметрами. Построчный отчёт пишется в CSV,
+сводка — в stdout.
+
+    python rescore.py --tariff 7.5 --cost-min 65000 --cost-max 100000 --out report.csv
+    python rescore.py --params new_prices.json --out report.csv
+
+JSON-файл параметров содержит любые поля EstimateParams, например
+{"tariff": 7.2, "region_tariffs": {"краснодарский край": 6.8}}.
+
+Тариф и выработка распознанных регионов берутся из regions.json, а --tariff
+и --kwh-per-kw действуют на остальные; с --no-regional — на все лиды.
+"""
+
+import argparse
+import csv
+import dataclasses
+import json
+import sys
+import time
+from functools import lru_cache
+from itertools import islice
+
+import numpy as np
+
+from estimator import (
+    DEFAULT_PARAMS,
+    EstimateParams,
+    estimate_batch,
+    lead_bill,
+    lead_category,
+    normalize_region,
+)
+from lead_store import create_lead_store
+
+REPORT_FIELDS = (
+    "user_id", "category", "region", "bill",
+    "power_kw", "cost_min", "cost_max", "payback_years",
+    "old_power_kw", "old_payback_years",
+)
+
+
+def load_params(args: argparse.Namespace) -> EstimateParams:
+    overrides = {}
+    if args.params:
+        with open(args.params, encoding="utf-8") as f:
+            overrides.update(json.load(f))
+    for name in ("tariff", "kwh_per_kw", "cost_min_per_kw", "cost_max_per_kw", "min_power_kw"):
+        value = getattr(args, name)
+        if value is not None:
+            overrides[name] = value
+    if args.no_regional:
+        overrides["regional"] = False
+    return dataclasses.replace(DEFAULT_PARAMS, **overrides)
+
+
+# Ответы клиентов сильно повторяются («5000», «Подмосковье») — разбор текста
+# занимает больше времени, чем сам расчёт, поэтому кэшируем его по значению поля
+@lru_cache(maxsize=65536)
+def _bill(text: str) -> int:
+    return lead_bill({"bill": text})
+
+
+@lru_cache(maxsize=65536)
+def _category(obj: str, region: str) -> str:
+    return lead_category({"object": obj, "region": region})
+
+
+@lru_cache(maxsize=65536)
+def _region(text: str) -> str:
+    return normalize_region(text)
+
+
+def _chunks(leads, size: int):
+    while True:
+        chunk = list(islice(leads, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def rescore(leads, params: EstimateParams, writer, chunk_size: int = 50_000) -> dict:
+    """Пересчитать поток (user_id, lead) и записать строки отчёта; вернуть сводку."""
+    count = 0
+    budget_old = budget_new = 0
+    paybacks_old: list[np.ndarray] = []
+    paybacks_new: list[np.ndarray] = []
+
+    for chunk in _chunks(leads, chunk_size):
+        user_ids = [user_id for user_id, _ in chunk]
+        bills = np.fromiter(
+            (_bill(lead.get("bill", "")) for _, lead in chunk), dtype=np.float64, count=len(chunk)
+        )
+        categories = np.array(
+            [_category(lead.get("object", ""), lead.get("region", "")) for _, lead in chunk]
+        )
+        regions = np.array([_region(lead.get("region", "")) for _, lead in chunk])
+
+        old = estimate_batch(bills, categories, regions, DEFAULT_PARAMS)
+        new = estimate_batch(bills, categories, regions, params)
+
+        if writer is not None:
+            writer.writerows(zip(
+                user_ids, categories.tolist(), regions.tolist(), bills.astype(np.int64).tolist(),
+                new.power_kw.tolist(), new.cost_min.tolist(), new.cost_max.tolist(),
+                new.payback_years.tolist(), old.power_kw.tolist(), old.payback_years.tolist(),
+            ))
+
+        count += len(chunk)
+        budget_old += int(((old.cost_min + old.cost_max) // 2).sum())
+        budget_new += int(((new.cost_min + new.cost_max) // 2).sum())
+        paybacks_old.append(old.payback_years)
+        paybacks_new.append(new.payback_years)
+
+    if not count:
+        return {"leads": 0}
+
+    old_pb = np.concatenate(paybacks_old)
+    new_pb = np.concatenate(paybacks_new)
+    return {
+        "leads": count,
+        "budget_total_old": budget_old,
+        "budget_total_new": budget_new,
+        "payback_median_old": float(np.median(old_pb)),
+        "payback_median_new": float(np.median(new_pb)),
+        "payback_improved": int((new_pb < old_pb).sum()),
+        "payback_worse": int((new_pb > old_pb).sum()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--params", metavar="JSON", help="файл с полями EstimateParams")
+    parser.add_argument("--tariff", type=float)
+    parser.add_argument("--kwh-per-kw", type=float)
+    parser.add_argument("--cost-min", dest="cost_min_per_kw", type=float)
+    parser.add_argument("--cost-max", dest="cost_max_per_kw", type=float)
+    parser.add_argument("--min-power", dest="min_power_kw", type=float)
+    parser.add_argument("--no-regional", action="store_true", help="не брать тариф и выработку из regions.json")
+    parser.add_argument("--store", help="бэкенд хранилища (по умолчанию LEAD_STORE)")
+    parser.add_argument("--path", help="файл хранилища (по умолчанию LEAD_STORE_PATH)")
+    parser.add_argument("--out", metavar="CSV", help="построчный отчёт; без него — только сводка")
+    parser.add_argument("--chunk", type=int, default=50_000)
+    args = parser.parse_args()
+
+    params = load_params(args)
+    store = create_lead_store(args.store, args.path)
+
+    started = time.perf_counter()
+    if args.out:
+        with open(args.out, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_FIELDS)
+            summary = rescore(store.iter_leads(), params, writer, args.chunk)
+    else:
+        summary = rescore(store.iter_leads(), params, None, args.chunk)
+    summary["elapsed_s"] = round(time.perf_counter() - started, 2)
+
+    json.dump(summary, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Состояние пользователя (context.user_data) и вытеснение простаивающих сессий из памяти.
+
+Session — компактная запись со слотами вместо словаря: этап воронки хранится
+членом перечисления Stage (один общий объект на всех, а не своя строка у каждого
+загруженного из базы пользователя), лид и память диалога — как раньше.
+Снаружи Session — обычный MutableMapping с ключами "stage", "lead", "memory",
+поэтому код, persistence и JSON в базе остались прежними.
+
+Без вытеснения Application держит user_data каждого, кто когда-либо писал боту,
+и память растёт с общим числом пользователей. SessionEvictor раз в
+SESSION_SWEEP_INTERVAL секунд выгружает сессии, простаивающие дольше
+SESSION_IDLE_TTL, в холодное хранилище на диске (та же SQLite-таблица persistence)
+и убирает их из памяти. При следующем сообщении сессия лениво загружается обратно
+в refresh_user_data — для обработчиков ничего не меняется.
+"""
+
+import asyncio
+import logging
+import os
+import resource
+import sys
+import time
+from collections.abc import MutableMapping
+from enum import StrEnum
+from typing import Iterator
+
+from telegram.ext import Application
+
+from metrics import PROCESS_RSS, SESSION_BYTES, SESSIONS_EVICTED, SESSIONS_IN_MEMORY
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(StrEnum):
+    """Этап воронки. StrEnum: сравнивается со строками и пишется в JSON как строка."""
+
+    CHAT = "chat"
+    WAITING_FOR_OBJECT = "waiting_for_object"
+    WAITING_FOR_REGION = "waiting_for_region"
+    WAITING_FOR_BILL = "waiting_for_bill"
+    WAITING_FOR_NAME = "waiting_for_name"
+    WAITING_FOR_PHONE = "waiting_for_phone"
+    DONE = "done"
+
+
+class Session(MutableMapping):
+    """
+    user_data одного пользователя. Незаданное поле (None) для словарного интерфейса
+    отсутствует — как ключ, которого не было в старом словаре.
+    """
+
+    __slots__ = ("stage", "lead", "memory", "extra", "last_seen")
+
+    FIELDS = ("stage", "lead", "memory")
+
+    def __init__(self):
+        self.stage: Stage | None = None
+        self.lead: dict | None = None
+        self.memory: dict | None = None
+        # Незнакомые ключи (на случай старых записей в базе) — обычно None
+        self.extra: dict | None = None
+        # Когда пользователь последний раз присылал апдейт (time.monotonic)
+        self.last_seen = time.monotonic()
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    # ---------------------------
+    # Словарный интерфейс
+    # ---------------------------
+
+    def __getitem__(self, key: str):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key: str, value) -> None:
+        if key == "stage":
+            value = Stage(value)
+        if key in self.FIELDS:
+            setattr(self, key, value)
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key in self.FIELDS:
+            if getattr(self, key) is None:
+                raise KeyError(key)
+            setattr(self, key, None)
+            return
+        if self.extra is None:
+            raise KeyError(key)
+        del self.extra[key]
+        if not self.extra:
+            self.extra = None
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self.FIELDS:
+            if getattr(self, key) is not None:
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(getattr(self, key) is not None for key in self.FIELDS) + len(self.extra or ())
+
+    def __repr__(self) -> str:
+        return f"Session({dict(self)!r})"
+
+
+# ===========================
+# ЗАМЕРЫ ПАМЯТИ
+# ===========================
+
+def deep_size(obj, _seen: set[int] | None = None) -> int:
+    """Примерный размер объекта вместе со всем, на что он ссылается (общие объекты — один раз)."""
+    seen = _seen if _seen is not None else set()
+    if id(obj) in seen or isinstance(obj, Stage):
+        # Члены Stage общие для всех сессий — в размер отдельной сессии не входят
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, Session):
+        size += sum(deep_size(getattr(obj, name), seen) for name in Session.__slots__)
+    return size
+
+
+def process_rss_bytes() -> int:
+    """Текущий resident set процесса (Linux — /proc, иначе пик из getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux отдаёт килобайты, macOS — байты
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+# ===========================
+# ВЫТЕСНЕНИЕ
+# ===========================
+
+class SessionEvictor:
+    def __init__(
+        self,
+        application: Application,
+        idle_ttl: float = 1800.0,
+        interval: float = 60.0,
+        size_samples: int = 200,
+    ):
+        self.application = application
+        self.idle_ttl = idle_ttl
+        self.interval = interval
+        # По скольким сессиям оценивать средний размер (полный обход был бы дорогим)
+        self.size_samples = size_samples
+        self.evicted = 0
+        self._task: asyncio.Task | None = None
+
+    @classmethod
+    def from_env(cls, application: Application) -> "SessionEvictor":
+        return cls(
+            application,
+            idle_ttl=float(os.getenv("SESSION_IDLE_TTL", "1800")),
+            interval=float(os.getenv("SESSION_SWEEP_INTERVAL", "60")),
+        )
+
+    # ---------------------------
+    # Жизненный цикл
+    # ---------------------------
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._loop(), name="session_evictor")
+
+    async def close(self) -> None:
+        logger.info("Сессии: %s", self.report())
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Не удалось выгрузить простаивающие сессии")
+
+    # ---------------------------
+    # Проход
+    # ---------------------------
+
+    async def sweep(self) -> int:
+        """Выгрузить простаивающие сессии и обновить замеры памяти. Возвращает число выгруженных."""
+        evicted = 0
+        persistence = self.application.persistence
+        # После stop() persistence уже сброшена на диск и закрыта — не трогаем
+        if self.idle_ttl > 0 and persistence is not None and self.application.running:
+            evicted = await self._evict(persistence)
+        stats = self.report()
+        if evicted:
+            logger.info("Выгружено простаивающих сессий: %s, сейчас: %s", evicted, stats)
+        return evicted
+
+    async def _evict(self, persistence) -> int:
+        deadline = time.monotonic() - self.idle_ttl
+        idle = {
+            user_id: (session, session.last_seen)
+            for user_id, session in self.application.user_data.items()
+            if session.last_seen < deadline
+        }
+        if not idle:
+            return 0
+
+        written = await persistence.spill({user_id: session for user_id, (session, _) in idle.items()})
+
+        evicted = 0
+        for user_id in written:
+            session, seen = idle[user_id]
+            # Пока писали на диск, пользователь вернулся — оставляем сессию в памяти
+            if self.application.user_data.get(user_id) is not session or session.last_seen != seen:
+                continue
+            self.application.drop_user_data(user_id)
+            persistence.forget(user_id)
+            evicted += 1
+
+        self.evicted += evicted
+        SESSIONS_EVICTED.inc(evicted)
+        return evicted
+
+    def report(self) -> dict:
+        sessions = self.application.user_data
+        sample = [s for _, s in zip(range(self.size_samples), sessions.values())]
+        per_session = sum(deep_size(s) for s in sample) / len(sample) if sample else 0.0
+        rss = process_rss_bytes()
+
+        SESSIONS_IN_MEMORY.set(len(sessions))
+        SESSION_BYTES.set(per_session)
+        PROCESS_RSS.set(rss)
+        stats = {
+            "in_memory": len(sessions),
+            "evicted_total": self.evicted,
+            "bytes_per_session": round(per_session),
+            "rss_mb": round(rss / 2**20, 1),
+        }
+        return stats
@@ -0,0 +1,157 @@
+"""
+Потоковая выдача ответа в Telegram: заглушка + правки сообщения по мере генерации.
+
+Telegram ограничивает частоту edit_message_text, поэтому правки
+прореживаются: первая — сразу, как только пришёл первый кусок текста,
+дальше не чаще одного раза в STREAM_EDIT_INTERVAL секунд.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator
+
+from telegram import Message
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины текста одного сообщения в Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+STREAM_PLACEHOLDER = "✍️ …"
+STREAM_CURSOR = " ▌"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Сколько раз переждать flood-лимит на правке, которую пропустить нельзя
+FLOOD_RETRIES = 5
+
+
+class StreamingReply:
+    """Одно сообщение-ответ, которое дописывается по мере прихода токенов."""
+
+    def __init__(self, reply_to: Message, min_interval: float = STREAM_EDIT_INTERVAL):
+        self.reply_to = reply_to
+        self.min_interval = min_interval
+
+        self.text = ""
+        self.first_text_at: float | None = None
+
+        self._started_at = time.monotonic()
+        self._message: Message | None = None
+        self._offset = 0  # с какого символа self.text начинается текущее сообщение
+        self._shown = ""
+        self._last_edit = 0.0
+        self._blocked_until = 0.0
+
+    async def start(self) -> None:
+        self._message = await self.reply_to.reply_text(STREAM_PLACEHOLDER)
+
+    async def _send(self, text: str) -> None:
+        if self._message is None:
+            # Без заглушки сообщение появляется вместе с первым текстом
+            self._message = await self.reply_to.reply_text(text)
+        else:
+            await self._message.edit_text(text)
+
+    async def _edit(self, text: str, wait: bool = False) -> None:
+        """
+        Показать text. Промежуточные правки при flood-лимите или сбое сети пропускаем —
+        следующая всё равно покажет текст целиком; wait=True — правка окончательная
+        (финал, заполненное сообщение): ждём retry_after или паузу и повторяем.
+        """
+        if text == self._shown:
+            return
+        for attempt in range(1, FLOOD_RETRIES + 1):
+            try:
+                await self._send(text)
+            except RetryAfter as e:
+                self._blocked_until = time.monotonic() + float(e.retry_after)
+                if not wait:
+                    return
+                if attempt == FLOOD_RETRIES:
+                    raise
+                logger.warning("Flood-лимит Telegram, ждём %s с перед правкой", e.retry_after)
+                await asyncio.sleep(float(e.retry_after))
+                continue
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+            except NetworkError as e:
+                # TimedOut и прочие сбои сети (BadRequest — тоже NetworkError, он выше)
+                if not wait:
+                    logger.debug("Промежуточная правка не прошла: %s", e)
+                    return
+                if attempt == FLOOD_RETRIES:
+                    raise
+                logger.warning("Сбой сети Telegram (%s), повтор правки через %s с", e, attempt)
+                await asyncio.sleep(attempt)
+                continue
+            break
+        self._shown = text
+        self._last_edit = time.monotonic()
+
+    async def _rollover(self) -> None:
+        """Текст не влезает в одно сообщение — фиксируем текущее и начинаем новое."""
+        end = self._offset + TELEGRAM_MESSAGE_LIMIT
+        await self._edit(self.text[self._offset:end], wait=True)
+        self._offset = end
+        self._message, self._shown = None, ""
+        await self._edit(self.text[end:] or STREAM_PLACEHOLDER, wait=True)
+
+    async def push(self, delta: str) -> None:
+        if not delta:
+            return
+        self.text += delta
+        now = time.monotonic()
+
+        if len(self.text) - self._offset > TELEGRAM_MESSAGE_LIMIT - len(STREAM_CURSOR):
+            await self._rollover()
+            return
+
+        if now < self._blocked_until:
+            return
+        if self.first_text_at is not None and now - self._last_edit < self.min_interval:
+            return
+
+        await self._edit(self.text[self._offset:] + STREAM_CURSOR)
+        if self.first_text_at is None:
+            self.first_text_at = now
+            logger.info(
+                "Первый текст ответа показан через %.0f мс",
+                (now - self._started_at) * 1000,
+            )
+
+    async def finish(self, fallback: str) -> None:
+        """Финальная правка без курсора (ждём flood-лимит, если он есть)."""
+        final = self.text[self._offset:].strip() or (fallback if not self._offset else "…")
+        delay = self._blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._edit(final, wait=True)
+
+
+async def stream_reply(
+    reply_to: Message,
+    chunks: AsyncIterator[str],
+    fallback: str = "Не получилось получить ответ от модели, попробуй спросить ещё раз.",
+    placeholder: bool = True,
+) -> str:
+    """
+    Показать ответ из потока кусков текста. Возвращает итоговый текст.
+    placeholder=False — не отправлять заглушку: до первого куска в чате ничего
+    не появляется, и генерацию можно отменить бесследно.
+    """
+    reply = StreamingReply(reply_to)
+    try:
+        if placeholder:
+            await reply.start()
+        async for delta in chunks:
+            await reply.push(delta)
+        await reply.finish(fallback)
+    finally:
+        # Сбой на стороне Telegram — закрываем и стрим модели, не дожидаясь сборщика мусора
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    return reply.text.strip() or fallback
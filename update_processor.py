@@ -0,0 +1,111 @@
+"""
+Параллельная обработка апдейтов с сохранением порядка внутри одного чата.
+
+Разные чаты обрабатываются одновременно (до max_concurrent_chats),
+а апдейты одного чата — строго по очереди: иначе два быстрых сообщения
+подряд сломают машину состояний stage в handle_message.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATE_LATENCY, new_trace_id
+
+logger = logging.getLogger(__name__)
+
+
+class _ChatSlot:
+    """Замок чата и число апдейтов, которые его держат или ждут."""
+
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Семафор базового класса ограничивает общее число принятых апдейтов
+    (включая ждущих своей очереди в чате), а собственный семафор — число
+    реально выполняющихся обработчиков. Так ожидающие апдейты одного
+    «болтливого» чата не занимают слоты, нужные другим чатам.
+    """
+
+    def __init__(self, max_concurrent_chats: int = 32, max_pending_updates: int = 1024):
+        super().__init__(max_concurrent_updates=max(max_pending_updates, max_concurrent_chats))
+        self.max_concurrent_chats = max_concurrent_chats
+        self._active = asyncio.Semaphore(max_concurrent_chats)
+        self._slots: dict[int, _ChatSlot] = {}
+
+    @classmethod
+    def from_env(cls) -> "ChatOrderedUpdateProcessor":
+        return cls(
+            max_concurrent_chats=int(os.getenv("MAX_CONCURRENT_CHATS", "32")),
+            max_pending_updates=int(os.getenv("MAX_PENDING_UPDATES", "1024")),
+        )
+
+    @property
+    def active_chats(self) -> int:
+        """Сколько чатов сейчас обрабатывается или ждёт очереди."""
+        return len(self._slots)
+
+    @staticmethod
+    def _chat_key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    @staticmethod
+    async def _timed(coroutine: Awaitable[Any], accepted: float) -> None:
+        started = time.perf_counter()
+        UPDATE_LATENCY.observe(started - accepted, phase="wait")
+        try:
+            await coroutine
+        finally:
+            UPDATE_LATENCY.observe(time.perf_counter() - started, phase="handle")
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Каждый апдейт обрабатывается в своей задаче, поэтому trace_id виден
+        # во всех логах обработчика и не протекает в соседние апдейты
+        new_trace_id(update.update_id if isinstance(update, Update) else None)
+        accepted = time.perf_counter()
+
+        key = self._chat_key(update)
+        if key is None:
+            async with self._active:
+                await self._timed(coroutine, accepted)
+            return
+
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _ChatSlot()
+        slot.users += 1
+        try:
+            async with slot.lock:
+                async with self._active:
+                    await self._timed(coroutine, accepted)
+        finally:
+            slot.users -= 1
+            # Чат затих — замок больше не нужен, не копим их для всех чатов подряд
+            if slot.users == 0:
+                del self._slots[key]
+
+    async def initialize(self) -> None:
+        logger.info(
+            "Параллельная обработка: до %s чатов одновременно", self.max_concurrent_chats
+        )
+
+    async def shutdown(self) -> None:
+        if self._slots:
+            logger.info("Остановка: в очереди остались апдейты %s чатов", len(self._slots))
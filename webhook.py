@@ -0,0 +1,252 @@
+"""
+Режим webhook: aiohttp-сервер принимает апдейты от Telegram и раздаёт их
+по N процессам-воркерам. Апдейты одного chat_id всегда попадают в один и тот же
+воркер (chat_id % N), поэтому машина состояний пользователя живёт в одном процессе.
+
+Эндпоинты:
+— POST {WEBHOOK_PATH}  — апдейты от Telegram (проверяется secret token);
+— GET  /healthz         — процесс жив;
+— GET  /readyz          — webhook установлен и все воркеры подняли Application.
+
+Для локальной разработки по-прежнему есть polling (BOT_MODE=polling).
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing as mp
+import os
+import secrets
+import signal
+
+from aiohttp import web
+from telegram import Bot
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес сервиса, без пути
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+
+# Как часто проверять, живы ли воркеры, сек
+SUPERVISE_INTERVAL = 2.0
+
+
+def chat_id_of(update: dict) -> int:
+    """chat_id (или id пользователя) из сырого JSON апдейта — ключ шардирования."""
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user and "id" in user:
+            return user["id"]
+    return 0
+
+
+# ===========================
+# ВОРКЕР
+# ===========================
+
+def _worker_main(shard: int, queue: mp.Queue, ready: mp.Event) -> None:
+    """Точка входа процесса-воркера: своё Application без Updater."""
+    from metrics import setup_logging
+
+    setup_logging(worker=shard)
+    # Ctrl+C получает вся группа процессов — останавливает нас фронт через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(shard, queue, ready))
+
+
+async def _run_worker(shard: int, queue: mp.Queue, ready: mp.Event) -> None:
+    import bot
+    from telegram import Update
+
+    bot.WORKER_SHARD = shard
+    app = bot.build_application(polling=False)
+    loop = asyncio.get_running_loop()
+
+    # post_init/post_shutdown сам вызывает только run_polling/run_webhook — здесь делаем это вручную
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        ready.set()
+        logger.info("Воркер %s готов", shard)
+        try:
+            while True:
+                data = await loop.run_in_executor(None, queue.get)
+                if data is None:
+                    break
+                await app.update_queue.put(Update.de_json(data, app.bot))
+        finally:
+            ready.clear()
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
+# ===========================
+# ФРОНТ
+# ===========================
+
+class WebhookFront:
+    def __init__(self, token: str, workers: int):
+        self.token = token
+        self.workers = workers
+        self.secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+        ctx = mp.get_context("spawn")
+        self._ctx = ctx
+        self.queues = [ctx.Queue() for _ in range(workers)]
+        self.ready = [ctx.Event() for _ in range(workers)]
+        self.processes: list[mp.process.BaseProcess | None] = [None] * workers
+        self.webhook_set = False
+        self._supervisor: asyncio.Task | None = None
+
+    def _spawn(self, shard: int) -> None:
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(shard, self.queues[shard], self.ready[shard]),
+            name=f"bot-worker-{shard}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[shard] = process
+
+    async def _supervise(self) -> None:
+        """Перезапускаем упавшие воркеры: их очередь с апдейтами остаётся во фронте."""
+        while True:
+            await asyncio.sleep(SUPERVISE_INTERVAL)
+            for shard, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(
+                        "Воркер %s завершился (код %s), перезапускаем", shard, process.exitcode
+                    )
+                    self.ready[shard].clear()
+                    self._spawn(shard)
+
+    # ---------------------------
+    # HTTP
+    # ---------------------------
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400)
+
+        shard = chat_id_of(data) % self.workers
+        self.queues[shard].put_nowait(data)
+        return web.Response()
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        workers = [
+            {
+                "shard": shard,
+                "alive": bool(process and process.is_alive()),
+                "ready": self.ready[shard].is_set(),
+            }
+            for shard, process in enumerate(self.processes)
+        ]
+        ok = self.webhook_set and all(w["alive"] and w["ready"] for w in workers)
+        return web.json_response(
+            {"ready": ok, "webhook_set": self.webhook_set, "workers": workers},
+            status=200 if ok else 503,
+        )
+
+    # ---------------------------
+    # Жизненный цикл
+    # ---------------------------
+
+    async def on_startup(self, app: web.Application) -> None:
+        for shard in range(self.workers):
+            self._spawn(shard)
+        self._supervisor = asyncio.create_task(self._supervise())
+
+        async with Bot(self.token) as tg:
+            await tg.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=self.secret,
+                allowed_updates=["message"],
+                max_connections=100,
+            )
+        self.webhook_set = True
+        logger.info(
+            "Webhook установлен: %s%s, воркеров: %s", WEBHOOK_URL, WEBHOOK_PATH, self.workers
+        )
+
+    async def on_cleanup(self, app: web.Application) -> None:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        for queue in self.queues:
+            queue.put(None)
+
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            if process is not None:
+                await loop.run_in_executor(None, process.join, 30)
+                if process.is_alive():
+                    process.terminate()
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        app.router.add_get("/healthz", self.healthz)
+        app.router.add_get("/readyz", self.readyz)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+
+async def _migrate_leads_to_sqlite() -> None:
+    """Перенести leads.jsonl (хранилище по умолчанию в polling) в sqlite до старта воркеров."""
+    from lead_store import create_lead_store, migrate_jsonl
+
+    store = create_lead_store("sqlite")
+    await store.start()
+    try:
+        await migrate_jsonl(store)
+    finally:
+        await store.close()
+
+
+def run_webhook(token: str, workers: int = WEBHOOK_WORKERS) -> None:
+    if not WEBHOOK_URL:
+        logger.error("Для BOT_MODE=webhook нужна переменная WEBHOOK_URL (публичный https-адрес).")
+        return
+
+    workers = max(1, workers)
+    if workers > 1:
+        # Несколько процессов не могут вести один append-only журнал с индексом в памяти
+        if os.getenv("LEAD_STORE", "").lower() == "jsonl":
+            logger.error(
+                "LEAD_STORE=jsonl не поддерживает несколько воркеров. "
+                "Используйте LEAD_STORE=sqlite или WEBHOOK_WORKERS=1."
+            )
+            return
+        if not os.getenv("LEAD_STORE"):
+            if os.getenv("LEAD_STORE_PATH"):
+                # Путь задан под jsonl — открыть его как sqlite нельзя, а угадывать опасно
+                logger.error(
+                    "Несколько воркеров требуют LEAD_STORE=sqlite. Задайте LEAD_STORE явно "
+                    "(и LEAD_STORE_PATH под него) или WEBHOOK_WORKERS=1."
+                )
+                return
+            os.environ["LEAD_STORE"] = "sqlite"
+            # Лиды, собранные в polling-режиме, не должны пропасть из виду
+            asyncio.run(_migrate_leads_to_sqlite())
+
+    front = WebhookFront(token, workers)
+    web.run_app(front.build_app(), port=WEBHOOK_PORT)